@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Compares DmxCommandParser's hand-written fast paths against the regex dispatch"""
+
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cinelighting"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import backends
+import dmx
+import dmxserver
+from run_benchmarks import NullHandler
+
+
+def make_parser(fast_paths):
+    parser = dmxserver.DmxCommandParser(dmx.ManolatorDmxController(backends.RecordingOutput()), NullHandler())
+    parser.fast_paths = fast_paths
+    return parser
+
+
+def bench_line(line, number):
+    results = {}
+    for fast_paths in (False, True):
+        parser = make_parser(fast_paths)
+        seconds = min(timeit.repeat(lambda: parser.process_command(line), number=number, repeat=5))
+        results[fast_paths] = number / seconds
+    return results
+
+
+if __name__ == '__main__':
+    lines = [
+        ("setm (256 pairs)", "setm " + ",".join("{}:{}".format(ch, ch % 256) for ch in range(1, 257)), 500),
+        ("set", "set 12:34", 20000),
+        ("getm (all)", "getm", 2000),
+        ("getm (16)", "getm " + ",".join(str(ch) for ch in range(1, 17)), 10000),
+    ]
+    print "{:<20} {:>14} {:>14} {:>8}".format("command", "regex/s", "fast/s", "speedup")
+    for name, line, number in lines:
+        results = bench_line(line, number)
+        print "{:<20} {:>14.0f} {:>14.0f} {:>7.2f}x".format(name, results[False], results[True], results[True] / results[False])
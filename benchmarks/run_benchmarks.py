@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Benchmarks the fade engine, controller and protocol hot paths.
+
+Prints a table, and with --json writes the results (operations per second,
+keyed by benchmark name) so that runs on different commits can be compared
+with --compare."""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cinelighting"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import backends
+import dmx
+import dmxserver
+
+# a result this much slower than the one compared against is reported as a regression
+REGRESSION_THRESHOLD = 0.8
+
+
+class NullHandler(object):
+    def track_async_runner(self, runner):
+        runner.cancel()
+        return 0
+
+
+class NullParallel(object):
+    """A parallel port which goes nowhere, to time ParallelPortOutput's own per-channel strobing"""
+
+    def setData(self, data):
+        pass
+
+    def setAutoFeed(self, auto_feed):
+        pass
+
+    def setDataStrobe(self, data_strobe):
+        pass
+
+
+def rate(func, number, repeat=5):
+    """Returns the best of repeat runs of func, in calls per second"""
+    return number / min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def make_modification(channels, keyframes):
+    mod = dmx.DmxModification()
+    easings = sorted(dmx.EASINGS.keys())
+    for ch in range(1, channels + 1):
+        for i in range(keyframes):
+            mod.set(time=i * 0.5, channel=ch, value=(i * 53 + ch * 7) % 256, easing=easings[(i + ch) % len(easings)])
+    mod.lock()
+    return mod
+
+
+def bench_step_at(results):
+    for channels in (1, 16, 256):
+        for keyframes in (2, 16, 128):
+            mod = make_modification(channels, keyframes)
+            duration = (keyframes - 1) * 0.5
+            for use_numpy in (False, True):
+                if use_numpy and dmx.numpy is None:
+                    continue
+                runner = dmx.DmxModificationRunner(None, mod, use_numpy=use_numpy)
+                # walk forwards through the fade, as the scheduler does
+                times = [duration * i / 100.0 for i in range(100)]
+                def step():
+                    for t in times:
+                        runner.step_at(t)
+                name = "step_at/{}ch/{}kf/{}".format(channels, keyframes, "numpy" if use_numpy else "python")
+                results[name] = rate(step, 5) * len(times)
+
+
+def bench_easings(results):
+    runner = dmx.DmxModificationRunner(None, make_modification(1, 2))
+    for easing in sorted(dmx.EASINGS.keys()):
+        def ease():
+            for i in range(100):
+                runner.calculate_easing(easing, i / 100.0, 0, 255)
+        results["easing/{}".format(easing)] = rate(ease, 200) * 100
+
+
+def bench_controller(results):
+    output = backends.RecordingOutput()
+    controller = dmx.ManolatorDmxController(output, frame_rate=40)
+    controller.start()
+    try:
+        values = dict((ch, ch % 256) for ch in range(1, 257))
+        results["controller/set_channel"] = rate(lambda: controller.set_channel(12, 34), 20000)
+        results["controller/get_channel"] = rate(lambda: controller.get_channel(12), 20000)
+        results["controller/set_channels/256"] = rate(lambda: controller.set_channels(values), 500)
+        results["controller/get_channels/256"] = rate(lambda: controller.get_channels(range(1, 257)), 500)
+        frame = bytes(bytearray(ch % 256 for ch in range(256)))
+        results["controller/set_channel_range/256"] = rate(lambda: controller.set_channel_range(1, frame), 5000)
+        results["controller/get_channel_range/256"] = rate(lambda: controller.get_channel_range(1, 256), 5000)
+        mask = controller.channel_mask(range(1, 257, 2))
+        full_frame = bytearray(257)
+        results["controller/apply_mask/128"] = rate(lambda: controller.apply_mask(mask, full_frame), 5000)
+    finally:
+        controller.stop()
+
+
+def bench_frame_output(results):
+    frame = bytearray(ch % 256 for ch in range(256))
+    recording = backends.RecordingOutput()
+    results["output/recording"] = rate(lambda: recording.write_frame(frame), 5000)
+    # without the reset pulse's sleep, which would swamp the strobing
+    parallel = backends.ParallelPortOutput(NullParallel(), reset_time=0)
+    results["output/parallel"] = rate(lambda: parallel.write_frame(frame), 1000)
+    with open(os.devnull, "wb") as devnull:
+        stream = backends.StreamOutput(devnull)
+        results["output/stream"] = rate(lambda: stream.write_frame(frame), 5000)
+
+
+def bench_parser(results):
+    parser = dmxserver.DmxCommandParser(dmx.ManolatorDmxController(backends.RecordingOutput()), NullHandler())
+    lines = [
+        ("set", "set 12:34", 20000),
+        ("setm/256", "setm " + ",".join("{}:{}".format(ch, ch % 256) for ch in range(1, 257)), 500),
+        ("get", "get 12", 20000),
+        ("getm/16", "getm " + ",".join(str(ch) for ch in range(1, 17)), 10000),
+        ("getm/all", "getm", 2000),
+        ("fill", "fill 1+256:40", 10000),
+        ("fade", "f 12:0:255:1", 2000),
+        ("version", "version", 20000),
+    ]
+    def process(line):
+        try:
+            parser.process_command(line)
+        except dmxserver.DmxCommandAsync:
+            pass
+    for name, line, number in lines:
+        results["parser/{}".format(name)] = rate(lambda: process(line), number)
+    parser.dmx.stop_fade_scheduler()
+
+
+BENCHMARKS = [bench_step_at, bench_easings, bench_controller, bench_frame_output, bench_parser]
+
+
+def git_revision():
+    try:
+        with open(os.devnull, "wb") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Returns the names of benchmarks which have regressed against baseline"""
+    regressions = []
+    print "{:<40} {:>14} {:>14} {:>8}".format("benchmark", "baseline/s", "now/s", "ratio")
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name]
+        flag = ""
+        if ratio < REGRESSION_THRESHOLD:
+            regressions.append(name)
+            flag = " REGRESSED"
+        print "{:<40} {:>14.0f} {:>14.0f} {:>7.2f}x{}".format(name, baseline[name], results[name], ratio, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare against the results in this file, exiting 1 on a regression")
+    parser.add_argument("--only", help="only run benchmarks whose function name contains this")
+    args = parser.parse_args()
+
+    results = {}
+    for bench in BENCHMARKS:
+        if args.only and args.only not in bench.__name__:
+            continue
+        bench(results)
+
+    if args.compare:
+        with open(args.compare, "rb") as f:
+            regressions = compare(results, json.load(f)["results"])
+    else:
+        print "{:<40} {:>14}".format("benchmark", "per second")
+        for name in sorted(results):
+            print "{:<40} {:>14.0f}".format(name, results[name])
+        regressions = []
+
+    if args.json:
+        with open(args.json, "wb") as f:
+            json.dump({
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "numpy": dmx.numpy.__version__ if dmx.numpy is not None else None,
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,85 @@
+import threading
+import time
+
+# how long the Manolator needs AutoFeed held to reset to channel 1
+PARALLEL_RESET_TIME = 0.1
+
+
+class BaseDmxOutput(object):
+    """Base class for whatever a controller's output thread writes its frames to.
+
+    write_frame is handed the whole frame at once (a bytearray, starting at
+    the first channel) so that backends can write it in bulk."""
+
+    def write_frame(self, frame):
+        raise NotImplementedError("Subclasses should override this method and implement it")
+
+    def close(self):
+        # implement if necessary
+        pass
+
+
+class ParallelPortOutput(BaseDmxOutput):
+    """Clocks frames into a Manolator through a pySerial parallel port object"""
+
+    def __init__(self, parallel, reset_time=PARALLEL_RESET_TIME):
+        self.parallel = parallel
+        self.reset_time = reset_time
+
+    def write_frame(self, frame):
+        p = self.parallel
+        set_data, set_data_strobe = p.setData, p.setDataStrobe
+
+        set_data(0)
+        p.setAutoFeed(1)
+        time.sleep(self.reset_time)
+        p.setAutoFeed(0)
+        for val in frame:
+            set_data(val)
+            set_data_strobe(1)
+            set_data_strobe(0)
+
+
+class RecordingOutput(BaseDmxOutput):
+    """Keeps every frame in memory - for tests and pre-visualisation"""
+
+    def __init__(self):
+        self.frames = []
+        self.frames_cv = threading.Condition()
+
+    def write_frame(self, frame):
+        with self.frames_cv:
+            self.frames.append(bytearray(frame))
+            self.frames_cv.notify_all()
+
+    def wait_for_frame(self, predicate=None, timeout=3):
+        """Waits for (and returns) a frame matching predicate, or None on timeout"""
+        deadline = time.time() + timeout
+        with self.frames_cv:
+            while True:
+                if self.frames and (predicate is None or predicate(self.frames[-1])):
+                    return self.frames[-1]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.frames_cv.wait(remaining)
+
+
+class StreamOutput(BaseDmxOutput):
+    """Writes each frame as raw bytes to a file-like object (a file, pipe or socket file) in one write"""
+
+    def __init__(self, stream, flush=True):
+        self.stream = stream
+        self.flush = flush
+
+    @classmethod
+    def open(cls, path, *args, **kwargs):
+        return cls(open(path, "ab", 0), *args, **kwargs)
+
+    def write_frame(self, frame):
+        self.stream.write(bytes(frame))
+        if self.flush:
+            self.stream.flush()
+
+    def close(self):
+        self.stream.close()
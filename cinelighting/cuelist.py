@@ -0,0 +1,113 @@
+import json
+import threading
+
+from cuetrack import BakedCue, BakedCueRunner
+from dmx import DmxModification, DmxModificationRunner, DMX_TAKEOVER_RELEASE, DMX_TAKEOVERS
+
+# options a cue can give its runners
+CUE_RUNNER_OPTIONS = ("interval", "priority", "takeover", "speed")
+
+
+class DmxCue(object):
+    """A cue from a show file: a locked DmxModification, compiled (or baked) when the show is loaded.
+
+    Every firing gets its own runner, but they all share the compiled curves."""
+
+    def __init__(self, number, modification, name=None, bake_rate=None, **options):
+        for option in options:
+            if option not in CUE_RUNNER_OPTIONS:
+                raise ValueError("Unknown cue option %r" % (option,))
+        if options.get("takeover", DMX_TAKEOVER_RELEASE) not in DMX_TAKEOVERS:
+            raise ValueError("Unknown takeover %r for cue %s" % (options["takeover"], number))
+        if options.get("speed", 1) <= 0:
+            raise ValueError("Speed must be positive for cue %s" % (number,))
+        self.number = number
+        self.name = name or ""
+        self.modification = modification
+        self.options = options
+
+        modification.lock()
+        compiled = modification.compile()
+        # vectorising is cached too, so firing never pays for it
+        compiled.vectorize()
+        self.channels = compiled.channels
+        self.duration = compiled.duration
+
+        self.baked = None
+        if bake_rate is not None:
+            self.baked = BakedCue.bake(modification, bake_rate)
+
+    @classmethod
+    def from_dict(cls, data):
+        modification = DmxModification()
+        for keyframe in data["keyframes"]:
+            modification.set(keyframe["time"], keyframe["channel"], keyframe["value"], keyframe.get("easing", "linear"))
+        options = dict((option, data[option]) for option in CUE_RUNNER_OPTIONS if option in data)
+        return cls(str(data["number"]), modification, data.get("name"), data.get("bake"), **options)
+
+    def runner(self, controller):
+        if self.baked is not None:
+            return BakedCueRunner(controller, self.baked, **self.options)
+        return DmxModificationRunner(controller, self.modification, **self.options)
+
+    def go(self, controller):
+        runner = self.runner(controller)
+        runner.start()
+        return runner
+
+
+class DmxCueList(object):
+    """An ordered list of cues, fired by number or in order with go.
+
+    A show file is JSON: {"cues": [{"number": "1", "name": "House to half",
+    "keyframes": [{"time": 0, "channel": 1, "value": 255}, {"time": 3,
+    "channel": 1, "value": 128, "easing": "ease_out"}]}, ...]}. Cues can
+    also give priority, takeover, speed and interval for their runners, and
+    bake (a frame rate) to be played back from a BakedCue instead."""
+
+    def __init__(self, cues, controller=None):
+        self.cues = list(cues)
+        self.cues_by_number = {}
+        for cue in self.cues:
+            if cue.number in self.cues_by_number:
+                raise ValueError("Cue %s appears twice" % (cue.number,))
+            if controller is not None:
+                # check the keyframes once, now, rather than each time it's fired
+                controller.validate_modification(cue.modification)
+            self.cues_by_number[cue.number] = cue
+        self.last_index = None
+        # go can be called from several connections at once
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data, controller=None):
+        return cls([DmxCue.from_dict(cue) for cue in data["cues"]], controller)
+
+    @classmethod
+    def load(cls, path, controller=None):
+        with open(path, "rb") as f:
+            return cls.from_dict(json.load(f), controller)
+
+    def __getitem__(self, number):
+        try:
+            return self.cues_by_number[str(number)]
+        except KeyError:
+            # not a KeyError, whose message would come out quoted
+            raise LookupError("No cue %s" % (number,))
+
+    def __len__(self):
+        return len(self.cues)
+
+    def go(self, controller, number=None):
+        """Fires cue number (or the cue after the last one fired), returning (cue, runner)"""
+        with self.lock:
+            if number is None:
+                index = 0 if self.last_index is None else self.last_index + 1
+                if index >= len(self.cues):
+                    raise IndexError("No more cues")
+                cue = self.cues[index]
+            else:
+                cue = self[number]
+                index = self.cues.index(cue)
+            self.last_index = index
+        return cue, cue.go(controller)
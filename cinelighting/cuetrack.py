@@ -0,0 +1,126 @@
+import array
+import math
+import mmap
+import struct
+
+from dmx import DmxModificationRunner, DmxRunner, DMX_MOD_DEFAULT_INTERVAL
+
+CUETRACK_MAGIC = "CLCUE\x01"
+CUETRACK_DEFAULT_RATE = 40
+
+# rate, frame count, channel count
+CUETRACK_HEADER = struct.Struct("<dII")
+# channel, first active frame, last active frame
+CUETRACK_CHANNEL = struct.Struct("<HII")
+
+
+class BakedCue(object):
+    """A locked DmxModification rendered ahead of time into dense frames at a fixed rate.
+
+    Each frame holds one byte per channel the cue uses (in self.channels
+    order). A channel is only driven between its first and last active
+    frame, just like the live runner stops touching channels outside their
+    keyframes."""
+
+    def __init__(self, rate, channels, active, frames, frame_count, frames_offset=0):
+        self.rate = rate
+        self.channels = channels
+        self.active = active # list of (first frame, last frame), per channel
+        self.frames = frames # array('B'), or an mmap when loaded from disk
+        self.frames_offset = frames_offset
+        self.frame_count = frame_count
+        self.duration = (frame_count - 1) / float(rate)
+
+    @classmethod
+    def bake(cls, modification, rate=CUETRACK_DEFAULT_RATE):
+        runner = DmxModificationRunner(None, modification)
+        for ch in runner.channels:
+            if not isinstance(ch, (int, long)):
+                raise ValueError("Only single-universe cues can be baked, not %r" % (ch,))
+        duration = runner.duration
+
+        channels = list(sorted(runner.channels))
+        index = dict((ch, i) for i, ch in enumerate(channels))
+        frame_count = int(math.ceil(duration * rate)) + 1
+        frames = array.array('B', [0] * (frame_count * len(channels)))
+        active = [None] * len(channels)
+
+        for frame in range(frame_count):
+            # the last frame is capped to the duration, as the live runner does
+            step = runner.step_at(min(frame / float(rate), duration))
+            base = frame * len(channels)
+            for ch, value in step.iteritems():
+                i = index[ch]
+                frames[base + i] = value
+                first, _ = active[i] or (frame, frame)
+                active[i] = (first, frame)
+
+        active = [a or (1, 0) for a in active] # never active
+        return cls(rate, channels, active, frames, frame_count)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a cue written by save - frames are paged in as they're played"""
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[:len(CUETRACK_MAGIC)] != CUETRACK_MAGIC:
+            raise ValueError("%r is not a baked cue file" % (path,))
+        offset = len(CUETRACK_MAGIC)
+        rate, frame_count, channel_count = CUETRACK_HEADER.unpack_from(mm, offset)
+        offset += CUETRACK_HEADER.size
+
+        channels, active = [], []
+        for _ in range(channel_count):
+            ch, first, last = CUETRACK_CHANNEL.unpack_from(mm, offset)
+            offset += CUETRACK_CHANNEL.size
+            channels.append(ch)
+            active.append((first, last))
+
+        return cls(rate, channels, active, mm, frame_count, offset)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(CUETRACK_MAGIC)
+            f.write(CUETRACK_HEADER.pack(self.rate, self.frame_count, len(self.channels)))
+            for ch, (first, last) in zip(self.channels, self.active):
+                f.write(CUETRACK_CHANNEL.pack(ch, first, last))
+            f.write(self.frame_bytes(0, self.frame_count))
+
+    def frame_bytes(self, first, count=1):
+        width = len(self.channels)
+        start = self.frames_offset + (first * width)
+        data = self.frames[start:start + (count * width)]
+        if isinstance(data, array.array):
+            return data.tostring()
+        return data
+
+    def frame_index_at(self, t):
+        return max(0, min(int(t * self.rate + 0.5), self.frame_count - 1))
+
+    def values_at_frame(self, frame):
+        values = bytearray(self.frame_bytes(frame))
+        output = {}
+        for i, ch in enumerate(self.channels):
+            first, last = self.active[i]
+            if first <= frame <= last:
+                output[ch] = values[i]
+        return output
+
+    def execute(self, controller, *args, **kwargs):
+        runner = BakedCueRunner(controller, self, *args, **kwargs)
+        runner.start()
+        return runner
+
+
+class BakedCueRunner(DmxRunner):
+    """Plays a BakedCue back through the controller's fade scheduler with no interpolation"""
+
+    def __init__(self, controller, cue, interval=DMX_MOD_DEFAULT_INTERVAL, **kwargs):
+        super(BakedCueRunner, self).__init__(controller, interval, **kwargs)
+        self.cue = cue
+        self.channels = set(cue.channels)
+        self.duration = cue.duration
+
+    def step_at(self, t):
+        return self.cue.values_at_frame(self.cue.frame_index_at(t))
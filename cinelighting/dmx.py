@@ -1,7 +1,18 @@
+import bisect
+import itertools
 import threading
 import time
+import traceback
 
+from backends import ParallelPortOutput
 from helpers import monotonic_time
+from outputprocess import SharedUniverse, start_output_process
+from snapshot import UniverseSnapshot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 DMX_MIN_VALUE = 0
 DMX_MAX_VALUE = 255
@@ -9,127 +20,708 @@ DMX_MAX_VALUE = 255
 DMX_MIN_CHANNEL = 1
 DMX_MAX_CHANNEL = 256
 
+# channels in a full universe, for controllers driving more than the Manolator's 256
+DMX_UNIVERSE_SIZE = 512
+# plain channel numbers refer to this universe
+DMX_DEFAULT_UNIVERSE = 1
+
+# how a channel is merged between layers of the same priority
+DMX_MERGE_LTP = "ltp" # latest takes precedence
+DMX_MERGE_HTP = "htp" # highest takes precedence
+
+# what starting a runner does to older runners driving any of the same channels
+DMX_TAKEOVER_RELEASE = "release" # the older runners stop driving those channels
+DMX_TAKEOVER_CANCEL = "cancel" # the older runners are cancelled outright
+DMX_TAKEOVER_SHARE = "share" # both carry on, mixed through their layers
+DMX_TAKEOVERS = (DMX_TAKEOVER_RELEASE, DMX_TAKEOVER_CANCEL, DMX_TAKEOVER_SHARE)
+
 DMX_MOD_DEFAULT_INTERVAL = 0.1
 
 DMX_MANOLATOR_INTERVAL = 0.1
 
+# frames per second to aim for while channels are changing
+DMX_MANOLATOR_FRAME_RATE = 10
+# frames per second to send regardless, so the interface never times out
+DMX_MANOLATOR_KEEPALIVE_RATE = 1
+
+# below this many channels the per-tick numpy overhead outweighs the per-channel python loop
+# (by benchmarks/run_benchmarks.py, python is still well ahead at 16 channels and level at about 32)
+DMX_NUMPY_MIN_CHANNELS = 32
+
 VERSION = 0.1
 
-class DmxModificationRunner(threading.Thread):
-    def __init__(self, controller, modification, interval=DMX_MOD_DEFAULT_INTERVAL):
+class DmxFadeScheduler(threading.Thread):
+    """Steps every active DmxModificationRunner of a controller from a single thread.
+
+    Each tick, all due runners are stepped and their outputs are merged (later
+    runners win) into one set_channels call on the controller. Runners with
+    their own layer (see DmxRunner) are written together, with a single mix.
+    A runner which fails to step or write is cancelled on its own, without
+    holding up the others.
+
+    A runner starting on channels which older runners are driving takes them
+    over, according to its takeover setting."""
+
+    def __init__(self, controller, interval=DMX_MOD_DEFAULT_INTERVAL):
         self.controller = controller
-        self.modification = modification
         self.interval = interval
 
-        self.has_run = False
-        self.callbacks = []
+        self.runners = []
+        self.runners_cv = threading.Condition()
+        # held while runners are stepped and written, so takeovers never land part way through a tick
+        self.tick_lock = threading.RLock()
+        self.keep_going = True
+        self.woken = False
 
-        self.calculate_values()
-
-        super(DmxModificationRunner, self).__init__()
+        super(DmxFadeScheduler, self).__init__(name="Dmx-Fade-Scheduler")
+        self.daemon = True
 
     def monotonic_clock(self):
         return monotonic_time()
 
-    def step(self):
-        # calculate next step
-        time_now = self.monotonic_clock()
-        time_relative = min(time_now - self.started, self.duration) # cap this to the duration
+    def note_active(self):
+        """Updates the fades.active gauge; called with runners_cv held, whenever runners changes"""
+        metrics = self.controller.metrics
+        if metrics is not None:
+            metrics.gauge("fades.active").set(len(self.runners))
+
+    def add(self, runner):
+        cancelled = []
+        with self.tick_lock, self.runners_cv:
+            if not self.keep_going:
+                raise RuntimeError("Fade scheduler has been stopped")
+            if runner.takeover != DMX_TAKEOVER_SHARE:
+                for older in self.runners:
+                    overlap = older.driven_channels() & runner.channels
+                    if not overlap:
+                        continue
+                    if runner.takeover == DMX_TAKEOVER_CANCEL or not older.release_channels(overlap):
+                        cancelled.append(older)
+                for older in cancelled:
+                    self.runners.remove(older)
+            runner.open_layer()
+            runner.scheduler = self
+            runner.started = self.monotonic_clock()
+            runner.next_step = runner.started
+            runner.timeline = (runner.started, 0, 0 if runner.paused else runner.speed)
+            self.runners.append(runner)
+            self.note_active()
+            self.runners_cv.notify_all()
+        metrics = self.controller.metrics
+        if metrics is not None:
+            metrics.counter("fades.started").add()
+            if cancelled:
+                metrics.counter("fades.taken_over").add(len(cancelled))
+        for older in cancelled:
+            older.finish(cancelled=True)
+
+    def remove(self, runner):
+        """Stops stepping runner, returning False if it wasn't running"""
+        with self.tick_lock, self.runners_cv:
+            if runner not in self.runners:
+                return False
+            self.runners.remove(runner)
+            self.note_active()
+        runner.finish(cancelled=True)
+        return True
+
+    def stop(self):
+        with self.runners_cv:
+            self.keep_going = False
+            self.runners_cv.notify_all()
+
+    def wake(self):
+        """Ticks straight away, rather than waiting for the next tick (e.g. after a runner is paused)"""
+        with self.runners_cv:
+            self.woken = True
+            self.runners_cv.notify_all()
+
+    def tick(self, time_now):
+        with self.tick_lock:
+            with self.runners_cv:
+                runners = list(self.runners)
+
+            # allow half a tick of slack so runners on our interval don't skip ticks
+            due = [runner for runner in runners
+                   if (not runner.paused or runner.controlled) and time_now + (self.interval / 2.0) >= runner.next_step]
+
+            stepped = []
+            finished = []
+            failed = []
+            for runner in due:
+                try:
+                    if runner.layer is None and len(due) == 1 and runner.can_step_masked():
+                        # nothing to merge with, so the frame can go straight to the controller
+                        masked, done = runner.step_masked(time_now)
+                        stepped.append((runner, None, masked))
+                    else:
+                        step_channels, done = runner.step(time_now)
+                        stepped.append((runner, step_channels, None))
+                except Exception:
+                    traceback.print_exc()
+                    failed.append(runner)
+                    continue
+                if done:
+                    finished.append(runner)
 
-        step_channels = self.step_at(time_relative)
-        self.controller.set_channels(step_channels)
+            try:
+                self.write(stepped)
+            except Exception:
+                # find the runners at fault by writing each on its own, so the others carry on
+                for entry in stepped:
+                    try:
+                        self.write([entry])
+                    except Exception:
+                        traceback.print_exc()
+                        failed.append(entry[0])
+            if failed:
+                finished = [runner for runner in finished if runner not in failed]
+
+            metrics = self.controller.metrics
+            if metrics is not None:
+                metrics.histogram("fades.tick").record(self.monotonic_clock() - time_now)
+
+        if finished or failed:
+            with self.runners_cv:
+                for runner in finished + failed:
+                    if runner in self.runners: # unless it's been cancelled since
+                        self.runners.remove(runner)
+                self.note_active()
+            for runner in finished:
+                runner.finish()
+            for runner in failed:
+                runner.finish(cancelled=True)
+
+    def write(self, stepped):
+        """Writes a tick's (runner, channels, masked frame) with as few controller calls as possible"""
+        output = {}
+        masked = None
+        layered = []
+        for runner, step_channels, runner_masked in stepped:
+            if runner_masked is not None:
+                masked = runner_masked
+            elif runner.layer is not None:
+                layered.append((runner.layer, step_channels))
+            else:
+                output.update(step_channels)
 
-        return time_relative >= self.duration
+        if layered:
+            self.controller.write_layers(layered, output)
+        else:
+            if masked is not None:
+                self.controller.apply_mask(*masked)
+            if output:
+                self.controller.set_channels(output)
 
     def run(self):
-        self.started = self.monotonic_clock()
-        while True:
-            if self.step():
-                break
-            time.sleep(self.interval)
-        self.has_run = True
-        for func in self.callbacks:
+        try:
+            next_tick = self.monotonic_clock()
+            while True:
+                with self.runners_cv:
+                    if self.keep_going and not self.runners:
+                        while self.keep_going and not self.runners:
+                            self.runners_cv.wait()
+                        next_tick = self.monotonic_clock()
+                    if not self.keep_going:
+                        break
+
+                try:
+                    self.tick(self.monotonic_clock())
+                except Exception:
+                    # runners are looked after in tick, so this is our own bug - keep going regardless
+                    traceback.print_exc()
+
+                next_tick += self.interval
+                delay = next_tick - self.monotonic_clock()
+                if delay > 0:
+                    with self.runners_cv:
+                        if not self.woken:
+                            self.runners_cv.wait(delay)
+                        self.woken = False
+                else:
+                    # we've fallen behind - don't try to catch up
+                    next_tick = self.monotonic_clock()
+        finally:
+            with self.runners_cv:
+                self.keep_going = False
+                runners, self.runners = self.runners, []
+                self.note_active()
+            for runner in runners:
+                # they never got to the end
+                runner.finish(cancelled=True)
+
+
+class DmxRunner(object):
+    """Something stepped by a DmxFadeScheduler: subclasses provide channels, duration and step_at.
+
+    A runner given a priority (or sharing its channels) writes into its own
+    layer of the controller, which is mixed with the others per channel;
+    whatever it leaves its channels at is kept when it finishes.
+
+    Runners follow their own timeline rather than the wall clock, so that they
+    can be paused, sped up and seeked; each change takes effect on the next
+    tick."""
+
+    def __init__(self, controller, interval=DMX_MOD_DEFAULT_INTERVAL, priority=None, takeover=DMX_TAKEOVER_RELEASE, speed=1.0):
+        if takeover not in DMX_TAKEOVERS:
+            raise ValueError("Unknown takeover %r" % (takeover,))
+        if speed <= 0:
+            raise ValueError("Speed must be positive, not %r" % (speed,))
+        self.controller = controller
+        self.interval = interval
+        self.priority = priority
+        self.takeover = takeover
+
+        self.scheduler = None
+        self.started = None
+        self.next_step = None
+
+        self.speed = float(speed)
+        self.paused = False
+        # (clock time, runner time at that clock time, runner seconds per clock second)
+        self.timeline = None
+        self.timeline_lock = threading.Lock()
+        # set by control, so that even a paused runner is stepped once to show the change
+        self.controlled = False
+
+        self.layer = None
+        # channels which newer runners have taken over
+        self.released = set()
+        self.cancelled = False
+
+        self.has_run = False
+        self.callbacks = []
+        self.callbacks_lock = threading.Lock()
+        self.done_event = threading.Event()
+
+    def start(self):
+        self.controller.get_fade_scheduler().add(self)
+
+    def join(self, timeout=None):
+        return self.done_event.wait(timeout)
+
+    def is_alive(self):
+        return self.started is not None and not self.done_event.is_set()
+
+    def position_at(self, time_now):
+        anchor_time, anchor_position, rate = self.timeline
+        return anchor_position + ((time_now - anchor_time) * rate)
+
+    def advance(self, time_now):
+        """Moves the runner on to time_now, returning (time into the runner, whether it's done)"""
+        self.controlled = False
+        time_relative = min(self.position_at(time_now), self.duration) # cap this to the duration
+
+        self.next_step += self.interval
+        if self.next_step < time_now:
+            self.next_step = time_now + self.interval
+
+        return time_relative, time_relative >= self.duration
+
+    def step(self, time_now):
+        time_relative, done = self.advance(time_now)
+        output = self.step_at(time_relative)
+        if self.released:
+            output = dict((ch, value) for ch, value in output.iteritems() if ch not in self.released)
+        return output, done
+
+    def driven_channels(self):
+        return self.channels - self.released
+
+    def release_channels(self, channels):
+        """Stops driving channels, holding their current values; returns False if there are none left"""
+        # replaced rather than updated, as the scheduler may be stepping us
+        self.released = self.released | set(channels)
+        if self.layer is not None:
+            self.controller.commit_layer(self.layer, channels)
+        return bool(self.driven_channels())
+
+    def open_layer(self):
+        if self.priority is not None or self.takeover == DMX_TAKEOVER_SHARE:
+            self.layer = self.controller.open_layer("runner-%x" % id(self), self.priority or 0)
+
+    def cancel(self):
+        """Stops the runner where it is, returning False if it had already finished"""
+        if self.scheduler is None:
+            return False
+        return self.scheduler.remove(self)
+
+    def control(self, position=None, speed=None, paused=None):
+        """Changes the runner's timeline from now on, stepping it on the next tick"""
+        if self.scheduler is None:
+            raise RuntimeError("Runner hasn't been started")
+        if speed is not None and speed <= 0:
+            raise ValueError("Speed must be positive, not %r" % (speed,))
+        with self.timeline_lock:
+            time_now = self.scheduler.monotonic_clock()
+            if position is None:
+                position = min(self.position_at(time_now), self.duration)
+            if speed is not None:
+                self.speed = float(speed)
+            if paused is not None:
+                self.paused = paused
+            self.timeline = (time_now, max(0, min(position, self.duration)), 0 if self.paused else self.speed)
+            self.next_step = time_now
+            self.controlled = True
+        self.scheduler.wake()
+
+    def pause(self):
+        self.control(paused=True)
+
+    def resume(self):
+        self.control(paused=False)
+
+    def seek(self, position):
+        """Jumps to position seconds into the runner (its duration jumps to the end, finishing it)"""
+        self.control(position=position)
+
+    def set_speed(self, speed):
+        self.control(speed=speed)
+
+    def position(self):
+        if self.timeline is None:
+            return 0
+        return min(self.position_at(self.scheduler.monotonic_clock()), self.duration)
+
+    def can_step_masked(self):
+        return False
+
+    def step_masked(self, time_now):
+        """Like step, but returns ((mask, frame), done) for BaseDmxController.apply_mask"""
+        time_relative, done = self.advance(time_now)
+        return self.masked_frame_at(time_relative), done
+
+    def finish(self, cancelled=False):
+        with self.callbacks_lock:
+            if self.has_run:
+                return
+            self.has_run = True
+            self.cancelled = cancelled
+            callbacks, self.callbacks = self.callbacks, []
+        metrics = self.controller.metrics if self.controller is not None else None
+        if metrics is not None:
+            metrics.counter("fades.cancelled" if cancelled else "fades.finished").add()
+        if self.layer is not None:
+            try:
+                self.controller.commit_layer(self.layer)
+                self.layer.release()
+            except Exception:
+                traceback.print_exc()
+        self.done_event.set()
+        for func in callbacks:
             func(self)
 
     def when_done(self, func):
-        if self.has_run:
-            func(self)
-        else:
-            self.callbacks.append(func)
+        with self.callbacks_lock:
+            if not self.has_run:
+                self.callbacks.append(func)
+                return self
+        func(self)
         return self
 
+    def step_at(self, t):
+        raise NotImplementedError("Subclasses should override this method and implement it")
+
+
+class DmxModificationRunner(DmxRunner):
+    def __init__(self, controller, modification, interval=DMX_MOD_DEFAULT_INTERVAL, use_numpy=None, **kwargs):
+        super(DmxModificationRunner, self).__init__(controller, interval, **kwargs)
+        self.modification = modification
+        self.use_numpy = use_numpy
+        # the channel mask of the last masked frame, reused until the active channels change
+        self.mask = None
+        self.mask_flags = None
+
+        self.calculate_values()
+
     def calculate_values(self):
         # calculate values
-        tv = dict(self.modification.time_values)
-        time_stops = list(sorted(tv.keys()))
-        chans = set(self.modification.using_channels)
+        compiled = self.modification.compile()
 
-        self.time_values = tv
-        self.channels = chans
-        self.time_stops = time_stops
-        self.duration = max(time_stops)
+        self.time_values = self.modification.time_values
+        self.channels = set(compiled.channels)
+        self.time_stops = compiled.time_stops
+        self.duration = compiled.duration
 
-        channel_time_stops = {}
-        for ch in self.channels:
-            channel_time_stops[ch] = [time_stop for time_stop in time_stops if ch in tv[time_stop].keys()]
-        self.channel_time_stops = channel_time_stops
+        if self.controller is not None:
+            for ch in compiled.channels:
+                self.controller.validate_channel(self.controller.normalize_channel(ch))
 
-    def calculate_easing(self, easing_type, percentage, last_val, next_val):
-        diff = next_val - last_val
+        self.curves = list(zip(compiled.channels, compiled.curves))
+        self.cursors = [1] * len(self.curves)
 
-        if easing_type == "ease_in_out":
-            if percentage < 0.5:
-                easing_type = "ease_in"
-                percentage *= 2
-                next_val = last_val + (diff/2)
-            else:
-                easing_type = "ease_out"
-                percentage = (percentage * 2) - 1
-                last_val += (diff/2)
-            diff = next_val - last_val
-
-        if callable(easing_type):
-            easing_type(percentage=percentage, last_val=last_val, next_val=next_val)
-        elif easing_type == "linear":
-            return last_val + (diff * percentage)
-        elif easing_type == "ease_in":
-            return last_val + (diff * pow(percentage, 2))
-        elif easing_type == "ease_out":
-            return last_val + (diff * (1-pow(1-percentage, 2)))
-        elif easing_type == "sudden":
-            # to use this easing type, you should put a stop 0.1 second before this
-            # with the LAST value
-            # then for the "FLASH" value, apply easing="sudden"
-            return next_val if percentage > 0.9 else last_val
-        raise ValueError("Unknown easing type %r" % (easing_type,))
+        # use_numpy=None picks the vectorised path whenever it's available and worthwhile
+        self.vector = None
+        if self.use_numpy or (self.use_numpy is None and len(self.curves) >= DMX_NUMPY_MIN_CHANNELS):
+            self.vector = compiled.vectorize()
+            if self.vector is None and self.use_numpy:
+                raise ValueError("This modification can't be evaluated with numpy")
+
+    def calculate_easing(self, easing_type, percentage, last_val, next_val):
+        return resolve_easing(easing_type)(percentage, last_val, next_val)
 
     def step_at(self, t):
+        if self.vector is not None:
+            return self.vector.step_at(t)
+        return self.step_at_python(t)
+
+    def frame_at(self, t):
+        """Returns (frame, mask) as arrays indexed by channel number (numpy mode only)"""
+        if self.vector is None:
+            raise RuntimeError("frame_at needs the numpy evaluation mode")
+        return self.vector.frame_at(t, self.controller.max_channel + 1)
+
+    def can_step_masked(self):
+        return self.vector is not None and self.controller.can_apply_masks()
+
+    def masked_frame_at(self, t):
+        frame, flags = self.frame_at(t)
+        if self.released:
+            flags[list(self.released)] = False
+        if self.mask is None or not numpy.array_equal(flags, self.mask_flags):
+            self.mask = self.controller.channel_mask(numpy.flatnonzero(flags).tolist())
+            self.mask_flags = flags
+        return self.mask, bytearray(frame.tostring())
+
+    def step_at_python(self, t):
         output = {}
-        for ch in self.channels:
-            try:
-                chts = self.channel_time_stops[ch]
+        cursors = self.cursors
+        for i, (ch, curve) in enumerate(self.curves):
+            new_value, cursors[i] = curve.value_at(t, cursors[i])
+            # None means that there's no "next time" or "last time"
+            # so we should STOP FIDDLING WITH IT
+            if new_value is not None:
+                output[ch] = int(round(new_value))
+        return output
 
-                # find the last time that the value was specified
-                last_time = max([ts for ts in chts if ts < t])
-                last_value = self.time_values[last_time][ch]
-                # and the next time
-                next_time = min([ts for ts in chts if ts >= t])
-                next_value = self.time_values[next_time][ch]
 
-                # now what percentage of the way we are through it
-                fade_duration = float(next_time - last_time)
-                fade_progress = float(t - last_time)
-                fade_percentage = fade_progress / fade_duration
+def easing_linear(percentage, last_val, next_val):
+    return last_val + ((next_val - last_val) * percentage)
+
+def easing_ease_in(percentage, last_val, next_val):
+    return last_val + ((next_val - last_val) * pow(percentage, 2))
+
+def easing_ease_out(percentage, last_val, next_val):
+    return last_val + ((next_val - last_val) * (1-pow(1-percentage, 2)))
+
+def easing_ease_in_out(percentage, last_val, next_val):
+    diff = next_val - last_val
+    if percentage < 0.5:
+        return easing_ease_in(percentage * 2, last_val, last_val + (diff/2))
+    return easing_ease_out((percentage * 2) - 1, last_val + (diff/2), next_val)
+
+def easing_sudden(percentage, last_val, next_val):
+    # to use this easing type, you should put a stop 0.1 second before this
+    # with the LAST value
+    # then for the "FLASH" value, apply easing="sudden"
+    return next_val if percentage > 0.9 else last_val
+
+EASINGS = {
+    "linear": easing_linear,
+    "ease_in": easing_ease_in,
+    "ease_out": easing_ease_out,
+    "ease_in_out": easing_ease_in_out,
+    "sudden": easing_sudden,
+}
+
+def resolve_easing(easing_type):
+    """Turns an easing name (or a custom callable) into a callable taking (percentage, last_val, next_val)"""
+    if callable(easing_type):
+        return lambda percentage, last_val, next_val: easing_type(percentage=percentage, last_val=last_val, next_val=next_val)
+    try:
+        return EASINGS[easing_type]
+    except (KeyError, TypeError):
+        raise ValueError("Unknown easing type %r" % (easing_type,))
 
-                new_value = self.calculate_easing(next_value["easing"], fade_percentage, last_value['value'], next_value['value'])
-                output[ch] = int(round(new_value))
-            except ValueError:
-                pass
-                # probably means that there's no "next time" or "last time"
-                # so we should STOP FIDDLING WITH IT
-        return output
 
+class DmxFadeCurve(object):
+    """The keyframes of a single channel, compiled for lookup by time.
+
+    value_at takes and returns a cursor (the index of the keyframe ending the
+    current segment) so that callers moving forward in time only ever look at
+    the next segment, falling back to a bisect for jumps."""
+
+    def __init__(self, keyframes):
+        # keyframes is a sorted list of (time, value, easing)
+        self.times = [kf[0] for kf in keyframes]
+        self.values = [kf[1] for kf in keyframes]
+        self.easing_types = [kf[2] for kf in keyframes]
+        self.easings = [resolve_easing(kf[2]) for kf in keyframes]
+
+    def segment_at(self, t, cursor=1):
+        times = self.times
+        if not (times[0] < t <= times[-1]):
+            return None
+        if times[cursor - 1] < t <= times[cursor]:
+            return cursor
+        if t > times[cursor]:
+            if t <= times[cursor + 1]:
+                return cursor + 1
+            return bisect.bisect_left(times, t, cursor + 1)
+        return bisect.bisect_left(times, t, 1, cursor)
+
+    def value_at(self, t, cursor=1):
+        segment = self.segment_at(t, cursor)
+        if segment is None:
+            return None, cursor
+
+        last_time = self.times[segment - 1]
+        # now what percentage of the way we are through it
+        fade_duration = float(self.times[segment] - last_time)
+        fade_progress = float(t - last_time)
+        fade_percentage = fade_progress / fade_duration
+
+        return self.easings[segment](fade_percentage, self.values[segment - 1], self.values[segment]), segment
+
+
+class DmxCompiledModification(object):
+    """A locked DmxModification with every channel compiled into a DmxFadeCurve"""
+
+    def __init__(self, modification):
+        tv = modification.time_values
+        self.time_stops = list(sorted(tv.keys()))
+        self.duration = max(self.time_stops)
+
+        channel_keyframes = {}
+        for time_stop in self.time_stops:
+            for ch, point in tv[time_stop].iteritems():
+                channel_keyframes.setdefault(ch, []).append((time_stop, point["value"], point["easing"]))
+
+        self.channels = list(sorted(channel_keyframes.keys()))
+        for ch in self.channels:
+            for kf in channel_keyframes[ch]:
+                # checked for both evaluation modes, as the numpy one would wrap out of range values around
+                if not (DMX_MIN_VALUE <= kf[1] <= DMX_MAX_VALUE):
+                    raise ValueError("DMX value '%r' out of range for channel %r" % (kf[1], ch))
+        self.curves = [DmxFadeCurve(channel_keyframes[ch]) for ch in self.channels]
+
+        self.vector = None
+        self.vectorized = False
+
+    def vectorize(self):
+        """Returns (and caches) a DmxVectorFade for this modification, or None if numpy can't evaluate it"""
+        if not self.vectorized:
+            self.vectorized = True
+            if DmxVectorFade.can_vectorize(self):
+                self.vector = DmxVectorFade(self)
+        return self.vector
+
+
+EASING_CODES = {
+    easing_linear: 0,
+    easing_ease_in: 1,
+    easing_ease_out: 2,
+    easing_ease_in_out: 3,
+    easing_sudden: 4,
+}
+
+def round_half_away(arr):
+    """numpy equivalent of python 2's round(), which rounds halves away from zero"""
+    up = numpy.floor(arr + 0.5)
+    up -= (up - arr) > 0.5
+    down = numpy.ceil(arr - 0.5)
+    down += (arr - down) > 0.5
+    return numpy.where(arr >= 0, up, down)
+
+
+class DmxVectorFade(object):
+    """A DmxCompiledModification laid out as padded (channel, keyframe) arrays.
+
+    Every channel is evaluated at once per tick; the arithmetic mirrors the
+    easing functions operation for operation, so the output is identical to
+    the pure python path."""
+
+    @staticmethod
+    def can_vectorize(compiled):
+        if numpy is None:
+            return False
+        for ch, curve in zip(compiled.channels, compiled.curves):
+            if not isinstance(ch, (int, long)):
+                return False
+            # python 2 halves integer differences with floor division in ease_in_out,
+            # so only pure integer curves are guaranteed to match
+            if not all(isinstance(v, (int, long)) for v in curve.values):
+                return False
+            for easing in curve.easing_types:
+                if callable(easing):
+                    return False
+        return True
+
+    def __init__(self, compiled):
+        curves = compiled.curves
+        key_count = max(len(curve.times) for curve in curves)
+
+        self.channels = numpy.array(compiled.channels, dtype=numpy.int64)
+        self.key_counts = numpy.array([len(curve.times) for curve in curves], dtype=numpy.int64)
+        # padding with infinity keeps the padding out of the "times < t" count
+        self.times = numpy.full((len(curves), key_count), numpy.inf)
+        self.values = numpy.zeros((len(curves), key_count), dtype=numpy.int64)
+        self.easings = numpy.zeros((len(curves), key_count), dtype=numpy.int8)
+        for i, curve in enumerate(curves):
+            n = len(curve.times)
+            self.times[i, :n] = curve.times
+            self.values[i, :n] = curve.values
+            self.easings[i, :n] = [EASING_CODES[easing] for easing in curve.easings]
+
+    def evaluate(self, t):
+        """Returns (rows, values) for the channels which have a value at time t"""
+        # segment is the bisect_left of t, per channel
+        segment = (self.times < t).sum(axis=1)
+        rows = numpy.nonzero((segment >= 1) & (segment < self.key_counts))[0]
+        segment = segment[rows]
+
+        last_time = self.times[rows, segment - 1]
+        next_time = self.times[rows, segment]
+        last_val = self.values[rows, segment - 1]
+        next_val = self.values[rows, segment]
+        easing = self.easings[rows, segment]
+
+        percentage = (t - last_time) / (next_time - last_time)
+        diff = next_val - last_val
+        half = diff // 2
+
+        # these mirror easing_* exactly - numpy.power (unlike **) goes through the same C pow()
+        pow_ = numpy.power
+        linear = last_val + (diff * percentage)
+        ease_in = last_val + (diff * pow_(percentage, 2.0))
+        ease_out = last_val + (diff * (1 - pow_(1 - percentage, 2.0)))
+        mid_val = last_val + half
+        in_out_first = last_val + ((mid_val - last_val) * pow_(percentage * 2, 2.0))
+        in_out_second = mid_val + ((next_val - mid_val) * (1 - pow_(1 - ((percentage * 2) - 1), 2.0)))
+        ease_in_out = numpy.where(percentage < 0.5, in_out_first, in_out_second)
+        sudden = numpy.where(percentage > 0.9, next_val, last_val)
+
+        result = numpy.choose(easing, [linear, ease_in, ease_out, ease_in_out, sudden])
+        return rows, round_half_away(result).astype(numpy.int64)
 
+    def step_at(self, t):
+        rows, values = self.evaluate(t)
+        return dict(zip(self.channels[rows].tolist(), values.tolist()))
+
+    def frame_at(self, t, size):
+        rows, values = self.evaluate(t)
+        frame = numpy.zeros(size, dtype=numpy.uint8)
+        mask = numpy.zeros(size, dtype=bool)
+        frame[self.channels[rows]] = values
+        mask[self.channels[rows]] = True
+        return frame, mask
+
+
+def parse_channel_address(channel):
+    """Normalises a channel address: 17 and "17" become 17, "2.17" and (2, 17) become (2, 17)"""
+    if isinstance(channel, tuple):
+        if len(channel) != 2:
+            raise ValueError("Invalid channel address %r" % (channel,))
+        return (int(channel[0]), int(channel[1]))
+    if isinstance(channel, basestring):
+        try:
+            if "." in channel:
+                universe, ch = channel.split(".", 1)
+                return (int(universe), int(ch))
+            return int(channel)
+        except ValueError:
+            raise ValueError("Invalid channel address %r" % (channel,))
+    return channel
 
 
 class DmxModification(object):
@@ -140,6 +732,7 @@ class DmxModification(object):
         
         self.using_channels = set()
         self.time_values = {}
+        self.compiled = None
 
     def execute(self, *args, **kwargs):
         """Shorthand for BaseDmxController.execute_change"""
@@ -149,6 +742,11 @@ class DmxModification(object):
 
     def set(self, time, channel, value, easing="linear"):
         assert not self.locked
+        resolve_easing(easing)
+        channel = parse_channel_address(channel)
+        if self.controller is not None:
+            # caught here, rather than by the fade scheduler part way through the fade
+            self.controller.validate_channel_and_value(self.controller.normalize_channel(channel), value)
 
         self.using_channels.add(channel)
         pointdict = self.time_values.setdefault(time, {}).setdefault(channel, {})
@@ -161,23 +759,103 @@ class DmxModification(object):
         assert not self.locked
         self.locked = True
 
+    def compile(self):
+        """Compiles (once) the curves of a locked modification, to be shared between its runners"""
+        assert self.locked
+        if self.compiled is None:
+            self.compiled = DmxCompiledModification(self)
+        return self.compiled
+
+
+
+class DmxLayer(object):
+    """A source of channel values (e.g. a live stream) merged with the other layers of a controller.
+
+    Per channel, the layers with the highest priority win; between those,
+    the channel's merge mode (DMX_MERGE_LTP or DMX_MERGE_HTP) decides."""
+
+    def __init__(self, controller, name, priority=0):
+        self.controller = controller
+        self.name = name
+        self.priority = priority
+
+        self.values = {}
+        self.stamps = {} # channel to the sequence number of its last write, for LTP
+
+    def set_channels(self, channels):
+        self.controller.write_layer(self, self.controller.validate_channels(channels))
+
+    def set_channel_range(self, start, data):
+        start = self.controller.validate_channel_range(start, len(data))
+        self.controller.write_layer(self, self.controller.range_to_dict(start, data))
+
+    def release(self):
+        self.controller.close_layer(self)
+
+
+class DmxChannelMask(object):
+    """A set of (already validated, single-universe) channels, for BaseDmxController.apply_mask.
+
+    The channels are precomputed into runs of consecutive channels, so that
+    controllers can copy them out of a frame a slice at a time."""
+
+    def __init__(self, channels):
+        self.channels = sorted(set(channels))
+        self.runs = [] # (first, last + 1)
+        for ch in self.channels:
+            if self.runs and self.runs[-1][1] == ch:
+                self.runs[-1] = (self.runs[-1][0], ch + 1)
+            else:
+                self.runs.append((ch, ch + 1))
 
 
 class BaseDmxController(object):
     """Base class describing a generic DMX controller API"""
 
-    def __init__(self, starting_values=None):
+    def __init__(self, starting_values=None, fade_interval=DMX_MOD_DEFAULT_INTERVAL, channel_count=DMX_MAX_CHANNEL, metrics=None):
+        # a metrics.DmxMetrics, or None to skip instrumentation entirely
+        self.metrics = metrics
+
         self.min_value = DMX_MIN_VALUE
         self.max_value = DMX_MAX_VALUE
 
         self.min_channel = DMX_MIN_CHANNEL
-        self.max_channel = DMX_MAX_CHANNEL
+        self.max_channel = DMX_MIN_CHANNEL + channel_count - 1
 
         self.has_started = False
 
+        self.fade_interval = fade_interval
+        self.fade_scheduler = None
+        self.fade_scheduler_lock = threading.Lock()
+
+        # empty until a layer is opened, when the manual layer (set_channels) is always first
+        self.layers = []
+        self.manual_layer = None
+        self.layers_lock = threading.RLock()
+        self.layer_sequence = itertools.count(1)
+        self.channel_modes = {}
+        self.default_merge_mode = DMX_MERGE_LTP
+
+        # channels set since take_changes was last called (None until track_changes)
+        self.changed_channels = None
+        self.changes_lock = threading.Lock()
+
         if starting_values is not None:
             self.set_channels(starting_values)
 
+    def normalize_channel(self, channel_id):
+        if type(channel_id) is int:
+            return channel_id
+        address = parse_channel_address(channel_id)
+        if isinstance(address, tuple):
+            universe, address = address
+            if universe != DMX_DEFAULT_UNIVERSE:
+                raise ValueError("Channel ID '%r' out of range" % (channel_id,))
+        return address
+
+    def all_channels(self):
+        return range(self.min_channel, self.max_channel + 1)
+
     def is_valid_channel(self, channel_id):
         return self.min_channel <= channel_id <= self.max_channel
 
@@ -198,38 +876,289 @@ class BaseDmxController(object):
 
 
     def set_channel(self, channel_id, set_to):
+        channel_id = self.normalize_channel(channel_id)
         self.validate_channel_and_value(channel_id, set_to)
-        self._set_channels({
+        self.apply_channels({
             channel_id: set_to
         })
 
-    def set_channels(self, channels):
+    def validate_channels(self, channels):
+        """Validates a dict of channels to values, returning it with the channels normalised"""
         channel_set = {}
         for channel, value in channels.iteritems():
+            channel = self.normalize_channel(channel)
             self.validate_channel_and_value(channel, value)
             channel_set[channel] = value
-        self._set_channels(channel_set)
+        return channel_set
+
+    def set_channels(self, channels):
+        self.apply_channels(self.validate_channels(channels))
+
+    def apply_channels(self, channel_set):
+        """Applies already validated manual channel values, merging them with any layers"""
+        with self.layers_lock:
+            if self.layers:
+                self.write_layer(self.manual_layer, channel_set)
+            else:
+                self._set_channels(channel_set)
+                self.note_changes(channel_set)
 
     def get_channel(self, channel_id):
+        channel_id = self.normalize_channel(channel_id)
         self.validate_channel(channel_id)
         return self._get_channels([channel_id])[channel_id]
 
     def get_channels(self, channels):
         channel_check = []
         for channel in channels:
+            channel = self.normalize_channel(channel)
             self.validate_channel(channel)
             channel_check.append(channel)
 
         return self._get_channels(channel_check)
 
+    def offset_channel(self, channel_id, offset):
+        return channel_id + offset
+
+    def validate_channel_range(self, start, count):
+        """Validates the count channels from start, returning start normalised"""
+        start = self.normalize_channel(start)
+        if count < 1 or not self.is_valid_channel(start) or not self.is_valid_channel(self.offset_channel(start, count - 1)):
+            raise ValueError("Channel range '%r'+%d out of range" % (start, count))
+        return start
+
+    def validate_frame(self, data):
+        """Validates every value in bytes-like data at once, returning it as a bytearray"""
+        data = data if isinstance(data, bytearray) else bytearray(data)
+        if data and (self.min_value > 0 or self.max_value < 255):
+            self.validate_value(min(data))
+            self.validate_value(max(data))
+        return data
+
+    def set_channel_range(self, start, data):
+        """Sets the len(data) channels from start to the bytes in data (anything bytes-like)"""
+        start = self.validate_channel_range(start, len(data))
+        if self.min_value > 0 or self.max_value < 255:
+            data = self.validate_frame(data)
+        self.apply_channel_range(start, data)
+
+    def fill_channel_range(self, start, count, value):
+        """Sets the count channels from start to value"""
+        start = self.validate_channel_range(start, count)
+        self.validate_value(value)
+        self.apply_channel_range(start, bytearray([value]) * count)
+
+    def apply_channel_range(self, start, data):
+        """Applies an already validated range, merging it with any layers"""
+        with self.layers_lock:
+            if self.layers:
+                self.write_layer(self.manual_layer, self.range_to_dict(start, data))
+            else:
+                self._set_channel_range(start, data)
+                if self.changed_channels is not None:
+                    self.note_changes([self.offset_channel(start, i) for i in range(len(data))])
+
+    def can_apply_masks(self):
+        """Whether channel_mask and apply_mask work here (they need plain channel numbers)"""
+        return True
+
+    def channel_mask(self, channels):
+        """Validates channels once, returning a DmxChannelMask to use with apply_mask"""
+        normalized = []
+        for channel in channels:
+            channel = self.normalize_channel(channel)
+            if not isinstance(channel, (int, long)):
+                raise ValueError("Channel masks can only hold single-universe channels, not %r" % (channel,))
+            self.validate_channel(channel)
+            normalized.append(channel)
+        return DmxChannelMask(normalized)
+
+    def apply_mask(self, mask, frame):
+        """Sets the channels of mask to their values in frame (bytes-like, indexed by channel number)"""
+        frame = self.validate_frame(frame)
+        if mask.channels and len(frame) <= mask.channels[-1]:
+            raise ValueError("Frame of %d values is too short for channel %d" % (len(frame), mask.channels[-1]))
+        with self.layers_lock:
+            if self.layers:
+                self.write_layer(self.manual_layer, dict((ch, frame[ch]) for ch in mask.channels))
+            else:
+                self._apply_mask(mask, frame)
+                self.note_changes(mask.channels)
+
+    def range_to_dict(self, start, data):
+        channels = [self.offset_channel(start, i) for i in range(len(data))]
+        return dict(zip(channels, bytearray(data)))
+
+    def get_channel_range(self, start, count):
+        """Returns the values of the count channels from start, as bytes"""
+        start = self.validate_channel_range(start, count)
+        return self._get_channel_range(start, count)
+
+    def set_channel_mode(self, channels, mode):
+        """Sets how channels are merged between layers (DMX_MERGE_LTP or DMX_MERGE_HTP)"""
+        if mode not in (DMX_MERGE_LTP, DMX_MERGE_HTP):
+            raise ValueError("Unknown merge mode %r" % (mode,))
+        with self.layers_lock:
+            for channel in channels:
+                channel = self.normalize_channel(channel)
+                self.validate_channel(channel)
+                self.channel_modes[channel] = mode
+
+    def open_layer(self, name, priority=0):
+        with self.layers_lock:
+            if not self.layers:
+                # from now on manual sets are kept apart, so they can be merged with the layers
+                manual = DmxLayer(self, "manual")
+                manual.values = self._get_channels(self.all_channels())
+                manual.stamps = dict.fromkeys(manual.values, 0)
+                self.manual_layer = manual
+                self.layers.append(manual)
+            layer = DmxLayer(self, name, priority)
+            self.layers.append(layer)
+            return layer
+
+    def close_layer(self, layer):
+        with self.layers_lock:
+            if layer not in self.layers:
+                return
+            self.layers.remove(layer)
+            mixed = self.mix_channels(layer.values)
+            if len(self.layers) == 1:
+                # only the manual layer is left, which is what the universe will hold
+                self.layers = []
+                self.manual_layer = None
+            if mixed:
+                self._set_channels(mixed)
+                self.note_changes(mixed)
+
+    def write_layer(self, layer, channel_set):
+        with self.layers_lock:
+            stamp = next(self.layer_sequence)
+            layer.values.update(channel_set)
+            layer.stamps.update(dict.fromkeys(channel_set, stamp))
+            mixed = self.mix_channels(channel_set)
+            if mixed:
+                self._set_channels(mixed)
+                self.note_changes(mixed)
+
+    def write_layers(self, updates, manual_channels=None):
+        """Writes a list of (layer, channels), and optionally manual channel values, with a single mix"""
+        updates = [(layer, self.validate_channels(channel_set)) for layer, channel_set in updates]
+        if manual_channels:
+            manual_channels = self.validate_channels(manual_channels)
+        with self.layers_lock:
+            if not self.layers:
+                # every layer has been closed in the meantime
+                if manual_channels:
+                    self.apply_channels(manual_channels)
+                return
+            if manual_channels:
+                updates.append((self.manual_layer, manual_channels))
+            changed = set()
+            for layer, channel_set in updates:
+                if layer not in self.layers:
+                    continue
+                stamp = next(self.layer_sequence)
+                layer.values.update(channel_set)
+                layer.stamps.update(dict.fromkeys(channel_set, stamp))
+                changed.update(channel_set)
+            mixed = self.mix_channels(changed)
+            if mixed:
+                self._set_channels(mixed)
+                self.note_changes(mixed)
+
+    def commit_layer(self, layer, channels=None):
+        """Moves layer's values (for channels, or all of them) into the manual layer, so they're kept without it"""
+        with self.layers_lock:
+            if layer not in self.layers:
+                return
+            if channels is None:
+                channels = list(layer.values)
+            held = {}
+            manual_values = self.manual_layer.values
+            for channel in channels:
+                if channel in layer.values:
+                    held[channel] = layer.values.pop(channel)
+                    del layer.stamps[channel]
+                    if self.channel_modes.get(channel, self.default_merge_mode) == DMX_MERGE_HTP:
+                        held[channel] = max(held[channel], manual_values.get(channel, 0))
+            if held:
+                self.write_layer(self.manual_layer, held)
+
+    def mix_channels(self, channels):
+        """Works out the merged value of each of channels across the layers"""
+        mixed = {}
+        layers = self.layers
+        channel_modes, default_mode = self.channel_modes, self.default_merge_mode
+        for channel in channels:
+            best = None
+            for layer in layers:
+                value = layer.values.get(channel)
+                if value is None:
+                    continue
+                if best is None or layer.priority > best[0]:
+                    best = (layer.priority, value, layer.stamps[channel])
+                elif layer.priority == best[0]:
+                    if channel_modes.get(channel, default_mode) == DMX_MERGE_HTP:
+                        if value > best[1]:
+                            best = (layer.priority, value, layer.stamps[channel])
+                    elif layer.stamps[channel] > best[2]:
+                        best = (layer.priority, value, layer.stamps[channel])
+            if best is not None:
+                mixed[channel] = best[1]
+        return mixed
+
+    def track_changes(self):
+        """Starts keeping track of which channels are set, for take_changes"""
+        with self.changes_lock:
+            if self.changed_channels is None:
+                self.changed_channels = set()
+
+    def untrack_changes(self):
+        with self.changes_lock:
+            self.changed_channels = None
+
+    def note_changes(self, channels):
+        if self.changed_channels is not None:
+            with self.changes_lock:
+                self.changed_channels.update(channels)
+
+    def take_changes(self):
+        """Returns the current values of the channels set since the last call"""
+        with self.changes_lock:
+            changed, self.changed_channels = self.changed_channels, set()
+        if not changed:
+            return {}
+        return self._get_channels(changed)
+
     def new_change(self, *args, **kwargs):
         return DmxModification(self, *args, **kwargs)
 
+    def validate_modification(self, modification):
+        """Checks every keyframe of a modification, so that its runners can't fail on a bad channel or value"""
+        for channel_values in modification.time_values.itervalues():
+            for channel, point in channel_values.iteritems():
+                self.validate_channel_and_value(self.normalize_channel(channel), point["value"])
+
     def execute_change(self, modification, *args, **kwargs):
+        self.validate_modification(modification)
         modification.lock()
         modification.runner = DmxModificationRunner(self, modification, *args, **kwargs)
         modification.runner.start()
 
+    def get_fade_scheduler(self):
+        with self.fade_scheduler_lock:
+            if self.fade_scheduler is None or not self.fade_scheduler.keep_going:
+                self.fade_scheduler = DmxFadeScheduler(self, self.fade_interval)
+                self.fade_scheduler.start()
+            return self.fade_scheduler
+
+    def stop_fade_scheduler(self):
+        with self.fade_scheduler_lock:
+            scheduler, self.fade_scheduler = self.fade_scheduler, None
+        if scheduler is not None:
+            scheduler.stop()
+            scheduler.join()
 
     def start(self, *args, **kwargs):
         if self.has_started:
@@ -243,6 +1172,7 @@ class BaseDmxController(object):
             raise RuntimeError("Not started")
 
         self._stop(*args, **kwargs)
+        self.stop_fade_scheduler()
         self.has_started = False
 
 
@@ -252,6 +1182,21 @@ class BaseDmxController(object):
     def _get_channels(self, channel_set):
         raise NotImplementedError("Subclasses should override this method and implement it")
 
+    def _set_channel_range(self, start, data):
+        # override if the controller can do better than a dict
+        channels = [self.offset_channel(start, i) for i in range(len(data))]
+        self._set_channels(dict(zip(channels, bytearray(data))))
+
+    def _apply_mask(self, mask, frame):
+        # override if the controller can do better than a dict
+        self._set_channels(dict((ch, frame[ch]) for ch in mask.channels))
+
+    def _get_channel_range(self, start, count):
+        # override if the controller can do better than a dict
+        channels = [self.offset_channel(start, i) for i in range(count)]
+        values = self._get_channels(channels)
+        return bytes(bytearray(values[ch] for ch in channels))
+
     def _start(self):
         # implement if necessary
         pass
@@ -261,79 +1206,359 @@ class BaseDmxController(object):
         pass
 
 class ManolatorDmxController(BaseDmxController):
-    def __init__(self, parallel, default_value=0, *args, **kwargs):
-        self.live_channels = dict((c, None) for c in range(DMX_MIN_CHANNEL, DMX_MAX_CHANNEL+1))
+    """Drives a Manolator; parallel is either a BaseDmxOutput or a pySerial parallel port object.
+
+    With output_process=True, frames are written by a child process reading
+    the universe from shared memory, so that nothing in this process (the
+    GIL included) can hold up output. The output then lives in the child:
+    frames it writes aren't seen by, e.g., a RecordingOutput or frame
+    listeners in this process, and output metrics aren't recorded."""
+
+    def __init__(self, parallel, default_value=0, frame_rate=DMX_MANOLATOR_FRAME_RATE,
+                 keepalive_rate=DMX_MANOLATOR_KEEPALIVE_RATE, partial_frames=False,
+                 reset_time=DMX_MANOLATOR_INTERVAL, output_process=False, snapshot_path=None, *args, **kwargs):
+        channel_count = kwargs.get("channel_count", DMX_MAX_CHANNEL)
+        # indexed directly by channel number (so index 0 is unused), and
+        # prefilled with the default so that unset channels need no special casing
+        self.live_channels = bytearray([default_value]) * (channel_count + 1)
+        # 1 for each channel which has been explicitly set
+        self.live_channels_set = bytearray(channel_count + 1)
         self.live_channels_cv = threading.Condition()
-        self.this_round_data = {}
+        # highest channel written since the output thread last took a frame (0 if none)
+        self.dirty_high = 0
 
         self.channel_default_value = default_value
 
-        self.parallel = parallel
+        self.frame_rate = frame_rate
+        self.keepalive_rate = keepalive_rate
+        # only clock out channels up to the highest one which changed
+        self.partial_frames = partial_frames
+
+        if not hasattr(parallel, "write_frame"):
+            parallel = ParallelPortOutput(parallel, reset_time)
+        self.output = parallel
         self.parallel_keep_going = False
+        # called with (time, frame) after each frame is written
+        self.frame_listeners = []
+
+        self.shared_universe = None
+        if output_process:
+            self.shared_universe = SharedUniverse(len(self.live_channels))
+            self.shared_universe.write(self.live_channels)
+
+        self.snapshot = None
+        if snapshot_path is not None:
+            self.snapshot = UniverseSnapshot(snapshot_path, len(self.live_channels))
+            # explicit starting values win over whatever the snapshot had
+            starting_values = self.snapshot.load()
+            starting_values.update(kwargs.get("starting_values") or {})
+            kwargs["starting_values"] = starting_values
 
         super(ManolatorDmxController, self).__init__(*args, **kwargs)
 
     def _start(self):
+        if self.snapshot is not None:
+            self.snapshot.start_flushing()
+
+        if self.shared_universe is not None:
+            self.shared_universe.running = True
+            self.output_process = start_output_process(
+                self.shared_universe, self.output, self.frame_rate, self.keepalive_rate,
+                self.partial_frames, self.min_channel, self.max_channel)
+            self.parallel_keep_going = True
+            self.parallel_ending_event = threading.Event()
+            # the only thing which waits on the child, so writes notice if it dies just as they would the thread
+            watcher = threading.Thread(target=self._watch_output_process, name="Manolator-Output-Watcher")
+            watcher.daemon = True
+            watcher.start()
+            return
+
         self.parallel_keep_going = True
         self.parallel_update_thread = threading.Thread(
             target=self._perform_parallel_update,
-            args=(self.parallel,),
+            args=(self.output,),
             name="Manolator-Parallel-Thread"
         )
         self.parallel_ending_event = threading.Event()
         self.parallel_update_thread.start()
 
     def _stop(self):
+        if self.snapshot is not None:
+            self.snapshot.stop_flushing()
+
+        if self.shared_universe is not None:
+            self.parallel_keep_going = False
+            self.shared_universe.running = False
+            if not self.parallel_ending_event.wait(5):
+                self.output_process.terminate()
+                raise RuntimeError("Output process has stalled!")
+            return
+
         assert self.parallel_update_thread.is_alive()
 
-        self.parallel_keep_going = False
+        with self.live_channels_cv:
+            self.parallel_keep_going = False
+            self.live_channels_cv.notify_all()
         if not self.parallel_ending_event.wait(5):
             raise RuntimeError("Parallel update thread has stalled!")
 
-    def _perform_parallel_update(self, p):
-        # pySerial parallel in p
+    def _watch_output_process(self):
+        try:
+            self.output_process.join()
+        finally:
+            self.parallel_keep_going = False
+            self.parallel_ending_event.set()
+
+    def add_frame_listener(self, listener):
+        """Calls listener(time, frame) from the output thread after each frame, so it must not block.
+
+        frame is a copy of every channel from min_channel to max_channel,
+        even when only part of it was clocked out."""
+        if self.shared_universe is not None:
+            raise RuntimeError("Frame listeners need the output in this process")
+        # replaced rather than changed, so the output thread never sees it half updated
+        self.frame_listeners = self.frame_listeners + [listener]
+
+    def remove_frame_listener(self, listener):
+        self.frame_listeners = [l for l in self.frame_listeners if l != listener]
+
+    def _wait_for_frame(self, next_frame, last_output):
+        """Waits (holding live_channels_cv) until a frame is due.
+
+        Returns True if it's a keepalive frame, which must be sent even if nothing changed."""
+        keepalive_interval = 1.0 / self.keepalive_rate
+        while self.parallel_keep_going:
+            time_now = monotonic_time()
+            keepalive_at = last_output + keepalive_interval
+            if time_now >= keepalive_at:
+                return True
+            if self.dirty_high and time_now >= next_frame:
+                return False
+            wake_at = min(keepalive_at, next_frame) if self.dirty_high else keepalive_at
+            self.live_channels_cv.wait(max(wake_at - time_now, 0))
+        return False
+
+    def _perform_parallel_update(self, output):
+        # writers only ever touch live_channels (the back buffer): we copy it
+        # into our own front buffer under the lock, then clock the frame out
+        # without holding it
+        frame = bytearray(len(self.live_channels))
+        last_frame = None
+        frame_interval = 1.0 / self.frame_rate
+        next_frame = last_output = float("-inf")
         try:
             while self.parallel_keep_going:
                 with self.live_channels_cv:
-                    self.live_channels_cv.wait(1)
-
-                    p.setData(0)
-                    p.setAutoFeed(1)
-                    time.sleep(0.1)
-                    p.setAutoFeed(0)
-                    for channel in range(0, self.max_channel):
-                        val = self.live_channels[channel]
-                        p.setData(self.channel_default_value if val is None else val)
-                        p.setDataStrobe(1)
-                        p.setDataStrobe(0)
+                    keepalive = self._wait_for_frame(next_frame, last_output)
+                    if not self.parallel_keep_going:
+                        break
+                    frame[:] = self.live_channels
+                    dirty_high, self.dirty_high = self.dirty_high, 0
+
+                if not keepalive and frame == last_frame:
+                    # written, but not actually changed
+                    continue
+
+                end = self.max_channel
+                if self.partial_frames and not keepalive and last_frame is not None:
+                    end = min(dirty_high, end)
+
+                time_now = monotonic_time()
+                output.write_frame(frame[self.min_channel:end + 1])
+
+                metrics = self.metrics
+                if metrics is not None:
+                    self._record_frame_metrics(metrics, keepalive, time_now, last_output, next_frame, frame_interval)
+
+                frame_listeners = self.frame_listeners
+                if frame_listeners:
+                    whole_frame = bytes(frame[self.min_channel:self.max_channel + 1])
+                    for listener in frame_listeners:
+                        try:
+                            listener(time_now, whole_frame)
+                        except Exception:
+                            traceback.print_exc()
+
+                if last_frame is None:
+                    last_frame = bytearray(frame)
+                else:
+                    last_frame[:] = frame
+                last_output = time_now
+                # deadline based, but don't try to catch up on frames we've missed
+                next_frame += frame_interval
+                if next_frame < time_now:
+                    next_frame = time_now + frame_interval
         finally:
             self.parallel_keep_going = False
             self.parallel_ending_event.set()
 
 
+    def _record_frame_metrics(self, metrics, keepalive, time_now, last_output, next_frame, frame_interval):
+        metrics.counter("output.keepalives" if keepalive else "output.frames").add()
+        metrics.histogram("output.write").record(monotonic_time() - time_now)
+        if last_output > float("-inf"):
+            metrics.histogram("output.interval").record(time_now - last_output)
+        # only frames which were waiting for their slot say anything about jitter
+        if not keepalive and 0 <= time_now - next_frame < frame_interval:
+            metrics.histogram("output.jitter").record(time_now - next_frame)
+
+    def _channels_written(self, runs):
+        # called holding live_channels_cv, with the (first, last + 1) runs of channels written
+        if self.shared_universe is not None:
+            self.shared_universe.write(self.live_channels)
+        if self.snapshot is not None:
+            self.snapshot.write(self.live_channels, self.live_channels_set, runs)
+        self.live_channels_cv.notify_all()
+
     def _set_channels(self, channel_set):
         if self.has_started and not self.parallel_keep_going:
             raise RuntimeError("Parallel port has died!")
 
+        if not channel_set:
+            return
+
+        high = max(channel_set)
+        metrics = self.metrics
+        if metrics is not None:
+            waiting = monotonic_time()
         with self.live_channels_cv:
+            if metrics is not None:
+                metrics.histogram("controller.lock_wait").record(monotonic_time() - waiting)
+            live_channels, live_channels_set = self.live_channels, self.live_channels_set
             for channel, value in channel_set.iteritems():
-                self.live_channels[channel] = value
-                self.this_round_data[channel] = value
-            self.live_channels_cv.notify_all()
+                live_channels[channel] = value
+                live_channels_set[channel] = 1
+            if high > self.dirty_high:
+                self.dirty_high = high
+            self._channels_written([(channel, channel + 1) for channel in channel_set] if self.snapshot is not None else None)
+
+    def _set_channel_range(self, start, data):
+        if self.has_started and not self.parallel_keep_going:
+            raise RuntimeError("Parallel port has died!")
+
+        end = start + len(data)
+        metrics = self.metrics
+        if metrics is not None:
+            waiting = monotonic_time()
+        with self.live_channels_cv:
+            if metrics is not None:
+                metrics.histogram("controller.lock_wait").record(monotonic_time() - waiting)
+            self.live_channels[start:end] = data
+            self.live_channels_set[start:end] = b"\x01" * len(data)
+            if data and end - 1 > self.dirty_high:
+                self.dirty_high = end - 1
+            self._channels_written([(start, end)])
+
+    def _apply_mask(self, mask, frame):
+        if self.has_started and not self.parallel_keep_going:
+            raise RuntimeError("Parallel port has died!")
+
+        if not mask.channels:
+            return
+
+        metrics = self.metrics
+        if metrics is not None:
+            waiting = monotonic_time()
+        with self.live_channels_cv:
+            if metrics is not None:
+                metrics.histogram("controller.lock_wait").record(monotonic_time() - waiting)
+            live_channels, live_channels_set = self.live_channels, self.live_channels_set
+            for start, end in mask.runs:
+                live_channels[start:end] = frame[start:end]
+                live_channels_set[start:end] = b"\x01" * (end - start)
+            if mask.channels[-1] > self.dirty_high:
+                self.dirty_high = mask.channels[-1]
+            self._channels_written(mask.runs)
 
     def _get_channels(self, channel_set):
         if self.has_started and not self.parallel_keep_going:
             raise RuntimeError("Parallel port has died!")
 
-        output = {}
         with self.live_channels_cv:
-            for channel in channel_set:
-                output[channel] = self.live_channels[channel]
-                if output[channel] is None:
-                    output[channel] = self.channel_default_value
+            live_channels = self.live_channels
+            return dict((channel, live_channels[channel]) for channel in channel_set)
+
+    def _get_channel_range(self, start, count):
+        if self.has_started and not self.parallel_keep_going:
+            raise RuntimeError("Parallel port has died!")
+
+        with self.live_channels_cv:
+            return bytes(self.live_channels[start:start + count])
+
+class MultiUniverseDmxController(BaseDmxController):
+    """Drives several universes at once, each through its own controller (and so its own output thread).
+
+    Channels are addressed as (universe, channel) tuples or "universe.channel"
+    strings; plain channel numbers refer to DMX_DEFAULT_UNIVERSE."""
+
+    def __init__(self, universes, *args, **kwargs):
+        # universes is either a dict of universe number to controller, or a list numbered from 1
+        if not isinstance(universes, dict):
+            universes = dict(enumerate(universes, DMX_DEFAULT_UNIVERSE))
+        self.universes = universes
+
+        super(MultiUniverseDmxController, self).__init__(*args, **kwargs)
 
+    def normalize_channel(self, channel_id):
+        address = parse_channel_address(channel_id)
+        if not isinstance(address, tuple):
+            return (DMX_DEFAULT_UNIVERSE, address)
+        return address
+
+    def all_channels(self):
+        return [(universe_id, ch)
+                for universe_id, universe in sorted(self.universes.iteritems())
+                for ch in universe.all_channels()]
+
+    def can_apply_masks(self):
+        return False
+
+    def is_valid_channel(self, channel_id):
+        universe_id, ch = channel_id
+        universe = self.universes.get(universe_id)
+        return universe is not None and universe.is_valid_channel(ch)
+
+    def _split_by_universe(self, channels):
+        per_universe = {}
+        for universe_id, ch in channels:
+            per_universe.setdefault(universe_id, []).append(ch)
+        return per_universe
+
+    def _set_channels(self, channel_set):
+        per_universe = {}
+        for (universe_id, ch), value in channel_set.iteritems():
+            per_universe.setdefault(universe_id, {})[ch] = value
+        for universe_id, universe_set in per_universe.iteritems():
+            self.universes[universe_id]._set_channels(universe_set)
+
+    def _get_channels(self, channel_set):
+        output = {}
+        for universe_id, channels in self._split_by_universe(channel_set).iteritems():
+            for ch, value in self.universes[universe_id]._get_channels(channels).iteritems():
+                output[(universe_id, ch)] = value
         return output
 
+    def offset_channel(self, channel_id, offset):
+        universe_id, ch = channel_id
+        return (universe_id, ch + offset)
+
+    def _set_channel_range(self, start, data):
+        universe_id, ch = start
+        self.universes[universe_id]._set_channel_range(ch, data)
+
+    def _get_channel_range(self, start, count):
+        universe_id, ch = start
+        return self.universes[universe_id]._get_channel_range(ch, count)
+
+    def _start(self):
+        for universe in self.universes.itervalues():
+            universe.start()
+
+    def _stop(self):
+        for universe in self.universes.itervalues():
+            universe.stop()
+
+
 class DummyDmxController(BaseDmxController):
     def _set_channels(self, channel_set):
         print time.time(), "Setting channels:", channel_set
@@ -0,0 +1,124 @@
+import bisect
+import sys
+import threading
+import time
+
+# upper bounds (in seconds) of the latency histogram buckets - anything slower lands in a final overflow bucket
+METRICS_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+)
+
+
+class DmxCounter(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def format(self):
+        return str(self.value)
+
+
+class DmxGauge(object):
+    """The latest value of something (e.g. how many fades are running)"""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def format(self):
+        return str(self.value)
+
+
+class DmxHistogram(object):
+    """Counts durations into fixed buckets, so recording one is cheap and memory never grows"""
+
+    def __init__(self, bounds=METRICS_LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, value):
+        bucket = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the fraction'th value (max for the overflow bucket)"""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return self.max
+
+    def format(self):
+        if not self.count:
+            return "count=0"
+        return "count={} mean={:.3f}ms p50<={:.3f}ms p99<={:.3f}ms max={:.3f}ms".format(
+            self.count, self.total / self.count * 1000, self.percentile(0.5) * 1000,
+            self.percentile(0.99) * 1000, self.max * 1000)
+
+
+class DmxMetrics(object):
+    """Named counters, gauges and histograms, shared by a controller, its runners and servers.
+
+    Instrumented code holds a metrics attribute which is None unless metrics
+    are enabled, and checks it before doing anything else - so disabled
+    metrics cost one attribute check."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.metrics_lock = threading.Lock()
+        self.dump_thread = None
+        self.dump_stopping = threading.Event()
+
+    def get(self, name, cls, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.metrics_lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(*args)
+        return metric
+
+    def counter(self, name):
+        return self.get(name, DmxCounter)
+
+    def gauge(self, name):
+        return self.get(name, DmxGauge)
+
+    def histogram(self, name, bounds=METRICS_LATENCY_BUCKETS):
+        return self.get(name, DmxHistogram, bounds)
+
+    def format(self):
+        with self.metrics_lock:
+            metrics = sorted(self.metrics.items())
+        return "\n".join("{} {}".format(name, metric.format()) for name, metric in metrics)
+
+    def start_dump(self, interval, stream=sys.stderr):
+        """Writes every metric to stream every interval seconds, from a background thread"""
+        def dump():
+            while not self.dump_stopping.wait(interval):
+                stream.write("--- metrics at {}\n{}\n".format(time.strftime("%H:%M:%S"), self.format()))
+                stream.flush()
+        self.dump_stopping.clear()
+        self.dump_thread = threading.Thread(target=dump, name="Dmx-Metrics-Dump")
+        self.dump_thread.daemon = True
+        self.dump_thread.start()
+
+    def stop_dump(self):
+        self.dump_stopping.set()
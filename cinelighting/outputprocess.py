@@ -0,0 +1,105 @@
+import mmap
+import multiprocessing
+import struct
+import time
+
+from helpers import monotonic_time
+
+# sequence number (odd while a write is in progress), then a byte saying whether the output process
+# should keep going - kept out of the sequence number, so writes can't put back a flag they read earlier
+SHARED_SEQUENCE = struct.Struct("=I")
+SHARED_RUNNING_OFFSET = SHARED_SEQUENCE.size
+SHARED_HEADER_SIZE = 8
+
+
+class SharedUniverse(object):
+    """A universe in anonymous shared memory, written by the controller and read by its output process.
+
+    Writes are guarded by a seqlock: the (single) writer makes the sequence
+    number odd, copies the values, then makes it even again, and readers
+    retry until they see the same even number before and after their copy.
+    Readers never block the writer, and never see a half-written frame."""
+
+    def __init__(self, size):
+        self.size = size
+        self.mm = mmap.mmap(-1, SHARED_HEADER_SIZE + size)
+        self.running = True
+
+    def sequence(self):
+        return SHARED_SEQUENCE.unpack_from(self.mm, 0)[0]
+
+    @property
+    def running(self):
+        return self.mm[SHARED_RUNNING_OFFSET] != "\x00"
+
+    @running.setter
+    def running(self, running):
+        # a single byte, which nothing else writes
+        self.mm[SHARED_RUNNING_OFFSET] = "\x01" if running else "\x00"
+
+    def write(self, data):
+        """Copies data (size bytes) in; only ever called with the controller's lock held"""
+        sequence = self.sequence()
+        SHARED_SEQUENCE.pack_into(self.mm, 0, sequence + 1)
+        self.mm[SHARED_HEADER_SIZE:] = bytes(data)
+        SHARED_SEQUENCE.pack_into(self.mm, 0, sequence + 2)
+
+    def read(self, frame):
+        """Copies the values into frame (a bytearray), returning the sequence number they're from"""
+        while True:
+            before = self.sequence()
+            if before % 2:
+                continue
+            frame[:] = self.mm[SHARED_HEADER_SIZE:]
+            if self.sequence() == before:
+                return before
+
+
+def run_output_process(universe, output, frame_rate, keepalive_rate, partial_frames, min_channel, max_channel):
+    """The output loop of a ManolatorDmxController with output_process=True, run in the child process.
+
+    Polls the shared universe once a frame, writing a frame when it has
+    changed, and at least keepalive_rate times a second regardless."""
+    frame = bytearray(universe.size)
+    last_frame = None
+    last_sequence = None
+    frame_interval = 1.0 / frame_rate
+    keepalive_interval = 1.0 / keepalive_rate
+    next_frame = last_output = float("-inf")
+    try:
+        while universe.running:
+            time_now = monotonic_time()
+            keepalive = time_now >= last_output + keepalive_interval
+            if keepalive or (time_now >= next_frame and universe.sequence() != last_sequence):
+                last_sequence = universe.read(frame)
+                if keepalive or frame != last_frame:
+                    end = max_channel
+                    if partial_frames and not keepalive and last_frame is not None:
+                        # the highest channel which differs from the last frame
+                        end = min_channel
+                        for ch in range(max_channel, min_channel - 1, -1):
+                            if frame[ch] != last_frame[ch]:
+                                end = ch
+                                break
+                    output.write_frame(frame[min_channel:end + 1])
+                    last_frame = bytearray(frame)
+                    last_output = time_now
+                    next_frame += frame_interval
+                    if next_frame < time_now:
+                        next_frame = time_now + frame_interval
+
+            # check for changes twice a frame, and sleep through to the next frame slot once one's been sent
+            wake_at = min(last_output + keepalive_interval, max(next_frame, time_now + (frame_interval / 2)))
+            delay = wake_at - monotonic_time()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        # an exception here ends the process, which the controller notices
+        output.close()
+
+
+def start_output_process(universe, *args):
+    process = multiprocessing.Process(target=run_output_process, args=(universe,) + args, name="Manolator-Output-Process")
+    process.daemon = True
+    process.start()
+    return process
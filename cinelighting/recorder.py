@@ -0,0 +1,236 @@
+import Queue
+import mmap
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+from helpers import monotonic_time
+
+RECORDING_MAGIC = "CLREC\x01"
+# flags
+RECORDING_HEADER = struct.Struct("<B")
+RECORDING_ZLIB = 0x01
+
+# seconds since the first frame, kind, payload length
+RECORDING_RECORD = struct.Struct("<dBH")
+RECORDING_KEYFRAME = 0 # payload: the whole frame
+RECORDING_DELTA = 1 # payload: RECORDING_RUN then its values, repeated
+RECORDING_RUN = struct.Struct("<HH") # first index, count
+
+# a keyframe every this many frames, so that a damaged file only loses a little
+RECORDING_KEYFRAME_INTERVAL = 200
+# at most this many frames wait for the writer before frames are dropped
+RECORDING_QUEUE_SIZE = 10000
+# unchanged values shorter than this between changes are folded into a single run
+RECORDING_RUN_GAP = 4
+RECORDING_CHUNK_SIZE = 65536
+
+
+def encode_delta(last_frame, frame):
+    """Returns the runs of frame which differ from last_frame (the same size), packed for a delta record"""
+    runs = []
+    start = end = None
+    for i in xrange(len(frame)):
+        if frame[i] != last_frame[i]:
+            if start is not None and i - end <= RECORDING_RUN_GAP:
+                end = i + 1
+            else:
+                if start is not None:
+                    runs.append((start, end))
+                start, end = i, i + 1
+    if start is not None:
+        runs.append((start, end))
+    return "".join(RECORDING_RUN.pack(start, end - start) + bytes(frame[start:end]) for start, end in runs)
+
+
+def apply_delta(frame, payload):
+    offset = 0
+    while offset < len(payload):
+        start, count = RECORDING_RUN.unpack_from(payload, offset)
+        offset += RECORDING_RUN.size
+        frame[start:start + count] = payload[offset:offset + count]
+        offset += count
+
+
+class FrameRecorder(object):
+    """Appends every frame a controller outputs to a file, from a background writer thread.
+
+    Frames are queued (never waited for) by the controller's output thread,
+    and the writer delta-encodes them against the previous frame, optionally
+    through zlib. Each batch is flushed, so the file is readable up to the
+    last batch even if we never get to close it."""
+
+    def __init__(self, path, compress=False, keyframe_interval=RECORDING_KEYFRAME_INTERVAL):
+        self.path = path
+        self.compress = compress
+        self.keyframe_interval = keyframe_interval
+
+        self.queue = Queue.Queue(RECORDING_QUEUE_SIZE)
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.controller = None
+
+        self.f = open(path, "wb")
+        self.f.write(RECORDING_MAGIC + RECORDING_HEADER.pack(RECORDING_ZLIB if compress else 0))
+        self.compressor = zlib.compressobj() if compress else None
+
+        self.writer = threading.Thread(target=self.write_frames, name="Dmx-Frame-Recorder")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def attach(self, controller):
+        self.controller = controller
+        controller.add_frame_listener(self.record)
+        return self
+
+    def record(self, timestamp, frame):
+        """Called with each frame as it's output (frame must not be changed afterwards)"""
+        try:
+            self.queue.put_nowait((timestamp, frame))
+        except Queue.Full:
+            self.frames_dropped += 1
+
+    def write_frames(self):
+        first_time = None
+        last_frame = None
+        since_keyframe = 0
+        finished = False
+        while not finished:
+            batch = [self.queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+
+            records = []
+            for timestamp, frame in batch:
+                if first_time is None:
+                    first_time = timestamp
+                if last_frame is None or len(frame) != len(last_frame) or since_keyframe >= self.keyframe_interval:
+                    kind, payload = RECORDING_KEYFRAME, bytes(frame)
+                    since_keyframe = 0
+                else:
+                    kind, payload = RECORDING_DELTA, encode_delta(last_frame, frame)
+                    since_keyframe += 1
+                records.append(RECORDING_RECORD.pack(timestamp - first_time, kind, len(payload)) + payload)
+                last_frame = frame
+            self.frames_written += len(records)
+
+            try:
+                self.write("".join(records), finished)
+            except Exception:
+                traceback.print_exc()
+        self.f.close()
+
+    def write(self, data, finished):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(
+                zlib.Z_FINISH if finished else zlib.Z_SYNC_FLUSH)
+        self.f.write(data)
+        self.f.flush()
+
+    def close(self):
+        if self.controller is not None:
+            self.controller.remove_frame_listener(self.record)
+            self.controller = None
+        self.queue.put(None)
+        self.writer.join()
+
+
+def read_chunks(path):
+    """Yields the (decompressed) records part of a recording, a chunk at a time"""
+    with open(path, "rb") as f:
+        header = f.read(len(RECORDING_MAGIC) + RECORDING_HEADER.size)
+        if header[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            raise ValueError("%r is not a frame recording" % (path,))
+        flags, = RECORDING_HEADER.unpack_from(header, len(RECORDING_MAGIC))
+
+        if flags & RECORDING_ZLIB:
+            decompressor = zlib.decompressobj()
+            while True:
+                chunk = f.read(RECORDING_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield decompressor.decompress(chunk)
+            yield decompressor.flush()
+            return
+
+        f.seek(0, 2)
+        if f.tell() == len(header):
+            # mmap can't map an empty file
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # paged in as we go, so recordings needn't fit in memory
+            for offset in xrange(len(header), len(mm), RECORDING_CHUNK_SIZE):
+                yield mm[offset:offset + RECORDING_CHUNK_SIZE]
+        finally:
+            mm.close()
+
+
+def read_recording(path):
+    """Yields (seconds since the first frame, frame) for each frame of a recording.
+
+    Each frame is a new bytearray. A truncated final record (from a
+    recording that never got closed) is ignored."""
+    frame = None
+    buf = ""
+    for chunk in read_chunks(path):
+        buf += chunk
+        offset = 0
+        while len(buf) - offset >= RECORDING_RECORD.size:
+            t, kind, length = RECORDING_RECORD.unpack_from(buf, offset)
+            start = offset + RECORDING_RECORD.size
+            if len(buf) - start < length:
+                break
+            payload = buf[start:start + length]
+            offset = start + length
+            if kind == RECORDING_KEYFRAME:
+                frame = bytearray(payload)
+            elif kind == RECORDING_DELTA and frame is not None:
+                frame = bytearray(frame)
+                apply_delta(frame, payload)
+            else:
+                raise ValueError("Bad record in %r" % (path,))
+            yield t, frame
+        buf = buf[offset:]
+
+
+def replay(path, controller, speed=1.0, start=0, sleep=time.sleep):
+    """Plays a recording into any BaseDmxController with its original timing (scaled by speed).
+
+    Frames before start seconds are skipped, and frames that we've fallen
+    behind on are dropped rather than played late - but the last frame is
+    always played, so the controller ends up at the recorded end state.
+    Returns the number of frames played."""
+    if speed <= 0:
+        raise ValueError("Speed must be positive, not %r" % (speed,))
+    played = 0
+    began = None
+    skipped = None
+    for t, frame in read_recording(path):
+        if t < start:
+            continue
+        if began is None:
+            began = monotonic_time()
+        due = began + ((t - start) / speed)
+        delay = due - monotonic_time()
+        if delay > 0:
+            sleep(delay)
+        elif delay < -(1.0 / speed) and played:
+            # more than a (recorded) second late
+            skipped = frame
+            continue
+        controller.set_channel_range(controller.min_channel, frame)
+        skipped = None
+        played += 1
+    if skipped is not None:
+        controller.set_channel_range(controller.min_channel, skipped)
+        played += 1
+    return played
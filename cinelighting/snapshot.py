@@ -0,0 +1,84 @@
+import mmap
+import os
+import struct
+import threading
+import traceback
+
+SNAPSHOT_MAGIC = "CLSNAP\x01"
+# universe size (including the unused index 0)
+SNAPSHOT_HEADER = struct.Struct("<H")
+SNAPSHOT_FLUSH_INTERVAL = 1.0
+
+
+class UniverseSnapshot(object):
+    """Keeps a controller's universe in a memory-mapped file, so that a restarted controller can pick up where it left off.
+
+    The file is the header, then the value of each channel, then a byte
+    for each channel which is 1 if it was explicitly set. Written channels
+    are copied straight into the mapping (the OS writes them back whenever
+    it likes, even if we crash), and a background thread msyncs them every
+    interval seconds so that little is lost if the machine goes down too."""
+
+    def __init__(self, path, size, interval=SNAPSHOT_FLUSH_INTERVAL):
+        self.path = path
+        self.size = size
+        self.interval = interval
+        self.offset = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+        self.header = SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(size)
+
+        length = self.offset + (size * 2)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fresh = os.fstat(fd).st_size != length or os.read(fd, self.offset) != self.header
+            if fresh:
+                # new, or for a different universe: start from nothing
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, length)
+            self.mm = mmap.mmap(fd, length)
+        finally:
+            # the mapping keeps its own reference to the file
+            os.close(fd)
+        if fresh:
+            self.mm[:self.offset] = self.header
+
+        self.dirty = False
+        self.flush_thread = None
+        self.flush_stopping = threading.Event()
+
+    def load(self):
+        """Returns the explicitly set channels as {channel: value}, for starting_values"""
+        values = self.mm[self.offset:self.offset + self.size]
+        set_flags = self.mm[self.offset + self.size:]
+        return dict((ch, ord(values[ch])) for ch in xrange(1, self.size) if set_flags[ch] != "\x00")
+
+    def write(self, values, set_flags, runs):
+        """Copies in the (first, last + 1) runs of the universe (bytearrays of size bytes); called with the controller's lock held"""
+        mm, values_at, flags_at = self.mm, self.offset, self.offset + self.size
+        for start, end in runs:
+            mm[values_at + start:values_at + end] = bytes(values[start:end])
+            mm[flags_at + start:flags_at + end] = bytes(set_flags[start:end])
+        self.dirty = True
+
+    def flush(self):
+        if self.dirty:
+            self.dirty = False
+            self.mm.flush()
+
+    def start_flushing(self):
+        def flush():
+            while not self.flush_stopping.wait(self.interval):
+                try:
+                    self.flush()
+                except Exception:
+                    traceback.print_exc()
+        self.flush_stopping.clear()
+        self.flush_thread = threading.Thread(target=flush, name="Dmx-Snapshot-Flush")
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def stop_flushing(self):
+        self.flush_stopping.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
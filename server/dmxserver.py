@@ -1,7 +1,15 @@
 import SocketServer as socketserver
+import asynchat
+import asyncore
+import collections
 import re
+import socket
+import struct
+import threading
 import traceback
 
+from helpers import monotonic_time
+
 class DmxProtocolException(Exception):
     short_error = "Protocol exception"
     def get_short_error(self):
@@ -15,6 +23,11 @@ class DmxCommandAsync(DmxProtocolException):
     def __init__(self, command_id):
         self.command_id = command_id
     short_error = "Async command starting"
+class DmxCommandDeferred(DmxProtocolException):
+    """Raised by handlers which can't block: the command completes (with OK) when runner is done"""
+    def __init__(self, runner):
+        self.runner = runner
+    short_error = "Command deferred"
 
 VERSION = "0.1"
 
@@ -24,6 +37,35 @@ def safe_int(val):
     except:
         raise DmxCommandInvalid()
 
+# picks the fixed first word(s) out of a command regex, e.g. "(c|get)" from r'^(c|get) ...'
+COMMAND_KEYWORD_RE = re.compile(r'^\^(?:\((?P<alternatives>[a-z]+(?:\|[a-z]+)*)\)|(?P<keyword>[a-z_]+|\\\?))(?: |\$|\()')
+
+def build_command_table(commands):
+    """
+    Precompiles a list of (regex, method name) commands into a dispatch table.
+
+    Returns ({first word: [(compiled regex, method name), ...]}, [(compiled
+    regex, method name), ...] for the commands which don't start with a fixed
+    word). Each list keeps the original order.
+    """
+    table, fallback = {}, []
+    for command, func in commands:
+        compiled = (re.compile(command), func)
+        res = COMMAND_KEYWORD_RE.match(command)
+        if res is None:
+            fallback.append(compiled)
+            continue
+        if res.group('alternatives'):
+            keywords = res.group('alternatives').split('|')
+        else:
+            keywords = [res.group('keyword').replace('\\', '')]
+        for keyword in keywords:
+            table.setdefault(keyword, []).append(compiled)
+    return table, fallback
+
+# returned by the hand-written fast paths for anything they don't handle, which then goes through the regexes
+FALLBACK = object()
+
 class DmxCommandParser(object):
     commands = [
         (r'^\?$', 'command_help'),
@@ -39,6 +81,21 @@ class DmxCommandParser(object):
         (r'^setm (?P<channels>([0-9]+:[0-9]+,)*[0-9]+:[0-9]+)?$', 'command_set_channels'),
 
         (r'^(v|version)$', 'command_version'),
+        (r'^fill (?P<start>[0-9]+)\+(?P<count>[0-9]+):(?P<value>[0-9]+)$', 'command_fill'),
+        (r'^go( (?P<number>[0-9]+(\.[0-9]+)?))?$', 'command_go'),
+        (r'^cues$', 'command_cues'),
+        (r'^cancel (?P<command_id>[0-9]+)$', 'command_cancel'),
+        (r'^pause (?P<command_id>[0-9]+)$', 'command_pause'),
+        (r'^resume (?P<command_id>[0-9]+)$', 'command_resume'),
+        (r'^seek (?P<command_id>[0-9]+) (?P<position>end|[0-9]+(\.[0-9]+)?)$', 'command_seek'),
+        (r'^speed (?P<command_id>[0-9]+) (?P<speed>[0-9]+(\.[0-9]+)?)$', 'command_speed'),
+        (r'^binary$', 'command_binary'),
+        (r'^stream( (?P<priority>[0-9]+))?$', 'command_stream'),
+        (r'^streams$', 'command_streams'),
+        (r'^stats$', 'command_stats'),
+        (r'^subscribe( (?P<channels>([0-9]+,)*[0-9]+))?$', 'command_subscribe'),
+        (r'^unsubscribe$', 'command_unsubscribe'),
+        (r'^merge (?P<mode>htp|ltp) (?P<channels>([0-9]+,)*[0-9]+)$', 'command_merge'),
 
         (r'^bye$', 'command_exit'),
         (r'^exit$', 'command_exit'),
@@ -57,36 +114,111 @@ class DmxCommandParser(object):
         (r'^q$', 'command_exit'),
     ]
 
+    # compiled once, and shared by every connection
+    command_table = build_command_table(commands)
+    fading_command_table = build_command_table(fading_commands)
+    # set commands can be parsed without being applied, so that runs of them can be coalesced
+    set_command_table = build_command_table([
+        (command, func.replace('command_', 'parse_'))
+        for command, func in commands
+        if func in ('command_set_channel', 'command_set_channels')
+    ])
+
+    # hand-written parsers for the hot commands, tried before the regexes
+    fast_commands = {
+        'setm': 'fast_set_channels',
+        'getm': 'fast_get_channels',
+    }
+    fast_paths = True
+
     MODE_NORMAL = 0
     MODE_FADING = 1
 
     def __init__(self, dmx, handler):
         self.dmx = dmx
         self.handler = handler
-        self.commands = self.preprocess_commands(self.commands)
-        self.fading_commands = self.preprocess_commands(self.fading_commands)
 
         self.mode = self.MODE_NORMAL
         self.data = {}
 
-    def preprocess_commands(self, commands):
-        cmds = []
-        for command, func in commands:
-            cmds.append((re.compile(command), getattr(self, func)))
-        return cmds
+    def dispatch(self, command_table, sock_input):
+        table, fallback = command_table
+        for command, func in table.get(sock_input.split(' ', 1)[0], ()):
+            res = command.match(sock_input)
+            if res:
+                return True, getattr(self, func)(**res.groupdict())
+        for command, func in fallback:
+            res = command.match(sock_input)
+            if res:
+                return True, getattr(self, func)(**res.groupdict())
+        return False, None
 
     def process_command(self, sock_input):
-        cmdset = self.commands
         if self.mode == self.MODE_FADING:
-            cmdset = self.fading_commands
-
-        for command, func in cmdset:
-            res = command.match(sock_input)
-            if res:
-                return func(**res.groupdict())
+            command_table = self.fading_command_table
+        else:
+            command_table = self.command_table
+            if self.fast_paths:
+                fast = self.fast_commands.get(sock_input.split(' ', 1)[0])
+                if fast is not None:
+                    out = getattr(self, fast)(sock_input)
+                    if out is not FALLBACK:
+                        return out
 
+        matched, out = self.dispatch(command_table, sock_input)
+        if matched:
+            return out
         raise DmxCommandInvalid()
 
+    def parse_set_command(self, sock_input):
+        """Returns the validated channels which a set/setm line sets, or None for any other line"""
+        if self.mode != self.MODE_NORMAL:
+            return None
+
+        if self.fast_paths:
+            keyword = sock_input.split(' ', 1)[0]
+            out = FALLBACK
+            if keyword == 'setm':
+                out = self.fast_parse_set_channels(sock_input[5:])
+            if out is not FALLBACK:
+                return self.dmx.validate_channels(out)
+
+        matched, out = self.dispatch(self.set_command_table, sock_input)
+        return out if matched else None
+
+    def fast_parse_set_channels(self, channels):
+        """Parses "ch:val,ch:val,...", or returns FALLBACK"""
+        out = {}
+        for pair in channels.split(','):
+            ch, sep, val = pair.partition(':')
+            if not (sep and ch.isdigit() and val.isdigit()):
+                return FALLBACK
+            out[int(ch)] = int(val)
+        return out
+
+    def fast_set_channels(self, sock_input):
+        out = self.fast_parse_set_channels(sock_input[5:])
+        if out is FALLBACK:
+            return FALLBACK
+        self.dmx.set_channels(out)
+
+    def fast_get_channels(self, sock_input):
+        if sock_input == 'getm':
+            return self.format_channels(None)
+        channels = sock_input[5:].split(',')
+        if sock_input[4:5] != ' ' or not all(ch.isdigit() for ch in channels):
+            return FALLBACK
+        channels = [int(ch) for ch in channels]
+        low, high = min(channels), max(channels)
+        dmx = self.dmx
+        if type(dmx.normalize_channel(low)) is not int or not (dmx.is_valid_channel(low) and dmx.is_valid_channel(high)):
+            # errors and multi-universe addresses are left to the regex path
+            return FALLBACK
+        # one slice copy, rather than validating and looking up each channel
+        data = bytearray(dmx.get_channel_range(low, high - low + 1))
+        values = dict((ch, data[ch - low]) for ch in channels)
+        return ",".join(["%d:%d" % item for item in values.iteritems()])
+
     def command_startfade(self):
         self.mode = self.MODE_FADING
         self.data['fade'] = self.dmx.new_change()
@@ -95,9 +227,7 @@ class DmxCommandParser(object):
     def fading_execute(self):
         c = self.data['fade']
         c.execute()
-        command_id = self.handler.get_async_command_id()
-        c.runner.when_done(lambda _: self.handler.async_done(command_id))
-        raise DmxCommandAsync(command_id)
+        raise DmxCommandAsync(self.handler.track_async_runner(c.runner))
 
     def fading_cancel(self):
         self.data['fade'] = None
@@ -122,17 +252,84 @@ class DmxCommandParser(object):
         change.set(seconds, ch, to_val)
         change.execute()
         if block == 'Y':
-            change.runner.join()
+            self.handler.wait_for_runner(change.runner)
         else:
-            command_id = self.handler.get_async_command_id()
-            change.runner.when_done(lambda _: self.handler.async_done(command_id))
-            raise DmxCommandAsync(command_id)
+            raise DmxCommandAsync(self.handler.track_async_runner(change.runner))
 
 
     def command_set_channel(self, channel, value):
         ch, val = safe_int(channel), safe_int(value)
         self.dmx.set_channel(ch, val)
 
+    def parse_set_channel(self, channel, value):
+        ch, val = safe_int(channel), safe_int(value)
+        return self.dmx.validate_channels({ch: val})
+
+    def command_fill(self, start, count, value):
+        self.dmx.fill_channel_range(safe_int(start), safe_int(count), safe_int(value))
+
+    def command_go(self, number=None):
+        cues = self.handler.server.cues
+        if cues is None:
+            raise ValueError("No show loaded")
+        _, runner = cues.go(self.dmx, number)
+        raise DmxCommandAsync(self.handler.track_async_runner(runner))
+
+    def command_cues(self):
+        cues = self.handler.server.cues
+        if cues is None:
+            raise ValueError("No show loaded")
+        return "\n".join("{} {:.2f}s {}".format(cue.number, cue.duration, cue.name).rstrip() for cue in cues.cues)
+
+    def command_cancel(self, command_id):
+        self.handler.get_async_runner(safe_int(command_id)).cancel()
+
+    def command_pause(self, command_id):
+        self.handler.get_async_runner(safe_int(command_id)).pause()
+
+    def command_resume(self, command_id):
+        self.handler.get_async_runner(safe_int(command_id)).resume()
+
+    def command_seek(self, command_id, position):
+        runner = self.handler.get_async_runner(safe_int(command_id))
+        runner.seek(runner.duration if position == "end" else float(position))
+
+    def command_speed(self, command_id, speed):
+        self.handler.get_async_runner(safe_int(command_id)).set_speed(float(speed))
+
+    def command_binary(self):
+        self.handler.enter_binary_mode()
+        return "BINARY"
+
+    def command_stream(self, priority=None):
+        self.handler.enter_stream_mode(0 if priority is None else safe_int(priority))
+        return "STREAMING"
+
+    def command_stats(self):
+        if self.dmx.metrics is None:
+            raise ValueError("Metrics are disabled")
+        return self.dmx.metrics.format()
+
+    def command_streams(self):
+        return self.handler.server.streams.format_stats()
+
+    def command_subscribe(self, channels=None):
+        if channels is None:
+            channels = range(self.dmx.min_channel, self.dmx.max_channel+1)
+        else:
+            channels = [safe_int(z) for z in channels.split(',')]
+        # subscribed by the controller's own keys, which are what its changes come back as
+        keys = self.dmx.validate_channels(dict.fromkeys(channels, 0))
+        self.handler.server.subscriptions.subscribe(self.handler, keys)
+        # the current values, which CHANGED lines then update
+        return self.format_channels(channels)
+
+    def command_unsubscribe(self):
+        self.handler.server.subscriptions.unsubscribe(self.handler)
+
+    def command_merge(self, mode, channels):
+        self.dmx.set_channel_mode([safe_int(z) for z in channels.split(',')], mode)
+
     def command_version(self):
         import dmx
         return "Server v{}, DMX v{}".format(VERSION, dmx.VERSION)
@@ -143,18 +340,27 @@ class DmxCommandParser(object):
 
 
     def command_set_channels(self, channels):
+        self.dmx.set_channels(self.parse_set_channels(channels))
+
+    def parse_set_channels(self, channels):
         chpairs = [z.split(':') for z in channels.split(',')]
         out = {}
         for ch, val in chpairs:
             ch, val = safe_int(ch), safe_int(val)
             out[ch] = val
-        self.dmx.set_channels(out)
+        return self.dmx.validate_channels(out)
 
     def command_get_channels(self, channels=None):
-        if channels is None:
-            channels = range(self.dmx.min_channel, self.dmx.max_channel+1)
-        else:
+        if channels is not None:
             channels = [safe_int(z) for z in channels.split(',')]
+        return self.format_channels(channels)
+
+    def format_channels(self, channels):
+        if channels is None:
+            # the whole universe, as one slice
+            start = self.dmx.min_channel
+            data = bytearray(self.dmx.get_channel_range(start, self.dmx.max_channel - start + 1))
+            return ",".join(["{}:{}".format(ch, val) for ch, val in enumerate(data, start)])
         channel_data = self.dmx.get_channels(channels)
         outp = ["{}:{}".format(ch, val) for ch, val in channel_data.iteritems()]
         return ",".join(outp)
@@ -169,6 +375,20 @@ class DmxCommandParser(object):
 - getm <channels>: returns the current value of <channels> (channels is comma-separated)
 - setm <cvps>: sets each channel to the value in <cvps> (cvps is in the format channel:value,channel:value,channel:value,... - Channel Value PairS)
 - v/version: returns the currently running software versions
+- fill <start>+<count>:<value>: sets the <count> channels from <start> to <value>
+- go (<cue>): fires <cue> of the loaded show (or the one after the last fired), as an async command
+- cues: lists the cues of the loaded show
+- cancel <id>: stops the fade started as async command <id> where it is (its ASYNCDONE says CANCELLED)
+- pause <id>/resume <id>: pauses and resumes the fade started as async command <id>
+- seek <id> <seconds|end>: jumps the fade started as async command <id> to <seconds> in, or its end
+- speed <id> <factor>: runs the fade started as async command <id> at <factor> times normal speed
+- binary: switches this connection to the binary protocol (length-prefixed messages, see BINARY_* in dmxserver.py)
+- stream (<priority>): switches this connection to streaming frames (2 byte length then values, no replies; a zero length frame ends it) into its own layer
+- stats: returns the controller's metrics (frame timing, fades, lock waits, command latency), if enabled
+- streams: returns the frame statistics of every stream
+- subscribe (<channels>): returns the values of <channels> (or all), then sends "CHANGED <ch>:<val>,..." lines as they change (channels is comma-separated)
+- unsubscribe: stops CHANGED lines
+- merge <htp|ltp> <channels>: sets how <channels> are merged between streams and manual sets (channels is comma-separated)
 - f <channel>(:<from_value>):<to_value>:<seconds>:<block Y|N>: immediately execute a fade of <channel> from <from_value> to <to_value> over <seconds> seconds, optionally <block>ing until complete
 
 Protocol notes:
@@ -186,65 +406,611 @@ BYE <note> - goodbye - closing connection
         raise DmxCommandExit()
         
 
-class DmxTcpHandler(socketserver.StreamRequestHandler):
+# bytes of output which can wait for a slow client before we stop reading from it
+OUTPUT_QUEUE_BYTES = 1 << 20
+
+INPUT_TEXT = 0
+INPUT_BINARY = 1
+INPUT_STREAM = 2
+
+# in binary mode, every message is a BINARY_HEADER (payload length, message type) then its payload
+BINARY_HEADER = struct.Struct("!HB")
+BINARY_RANGE = struct.Struct("!H") # start channel
+BINARY_GET = struct.Struct("!HH") # start channel, channel count
+BINARY_KEYFRAME = struct.Struct("!fHBB") # time, channel, value, easing (index into BINARY_EASINGS)
+BINARY_COMMAND_ID = struct.Struct("!I")
+BINARY_CHANGE = struct.Struct("!HB") # channel, value
+
+# client to server
+BINARY_SET_FRAME = 0x01 # payload: values from the first channel onwards
+BINARY_SET_RANGE = 0x02 # payload: BINARY_RANGE, values
+BINARY_GET_RANGE = 0x03 # payload: BINARY_GET
+BINARY_FADE = 0x04 # payload: BINARY_KEYFRAME repeated
+BINARY_TEXT = 0x05 # return to the text protocol
+# server to client
+BINARY_OK = 0x80
+BINARY_ERROR = 0x81 # payload: reason
+BINARY_DATA = 0x82 # payload: BINARY_RANGE, values
+BINARY_ASYNCPENDING = 0x83 # payload: BINARY_COMMAND_ID
+BINARY_ASYNCDONE = 0x84 # payload: BINARY_COMMAND_ID, optional note
+BINARY_CHANGED = 0x85 # payload: BINARY_CHANGE repeated
+
+# in stream mode, every frame is a STREAM_HEADER (frame length) then the values from the first channel;
+# a zero length frame ends the stream
+STREAM_HEADER = struct.Struct("!H")
+
+# the same order as dmx.EASING_CODES
+BINARY_EASINGS = ["linear", "ease_in", "ease_out", "ease_in_out", "sudden"]
+
+def binary_message(msg_type, payload=""):
+    return BINARY_HEADER.pack(len(payload), msg_type) + payload
+
+
+class DmxStreamSession(object):
+    """A connection streaming frames into its own layer of the controller"""
+    def __init__(self, name, layer):
+        self.name = name
+        self.layer = layer
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.frames_applied = 0
+        self.errors = 0
+
+    def apply(self, frames):
+        """Applies the latest of frames, dropping the stale ones"""
+        self.frames_received += len(frames)
+        self.frames_dropped += len(frames) - 1
+        self.layer.set_channel_range(self.layer.controller.min_channel, frames[-1])
+        self.frames_applied += 1
+
+    def format_stats(self):
+        return "{} priority={} received={} dropped={} applied={} errors={}".format(
+            self.name, self.layer.priority, self.frames_received, self.frames_dropped, self.frames_applied, self.errors)
+
+
+class DmxStreamRegistry(object):
+    """Keeps track of a server's stream sessions, so that any connection can query them"""
+    def __init__(self):
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+        self.session_count = 0
+
+    def open(self, dmx, priority):
+        with self.sessions_lock:
+            self.session_count += 1
+            name = "stream{}".format(self.session_count)
+            session = DmxStreamSession(name, dmx.open_layer(name, priority))
+            self.sessions.append(session)
+            return session
+
+    def close(self, session):
+        with self.sessions_lock:
+            self.sessions.remove(session)
+        session.layer.release()
+
+    def format_stats(self):
+        with self.sessions_lock:
+            return "\n".join(session.format_stats() for session in self.sessions)
+
+
+# how often subscribers are told about changes, at most
+SUBSCRIPTION_DEFAULT_RATE = 10
+
+
+class DmxChangeNotifier(object):
+    """Pushes changed channel values to subscribed connections.
+
+    Changes are taken from the controller's change tracking at most rate
+    times a second, so however many connections subscribe there's one diff
+    per tick; each subscriber is then sent the part it asked for."""
+
+    def __init__(self, dmx, rate=SUBSCRIPTION_DEFAULT_RATE):
+        self.dmx = dmx
+        self.interval = 1.0 / rate
+        self.subscribers = {} # handler to the set of channels it wants
+        self.subscribers_lock = threading.Lock()
+        # the thread's stop event, while there are subscribers
+        self.stopping = None
+
+    def subscribe(self, handler, channels):
+        with self.subscribers_lock:
+            self.subscribers[handler] = frozenset(channels)
+            if self.stopping is None:
+                self.dmx.track_changes()
+                self.stopping = threading.Event()
+                thread = threading.Thread(target=self.run, args=(self.stopping,))
+                thread.daemon = True
+                thread.start()
+
+    def unsubscribe(self, handler):
+        with self.subscribers_lock:
+            self.subscribers.pop(handler, None)
+            if not self.subscribers and self.stopping is not None:
+                # nobody's listening: stop ticking, and stop the controller keeping track for us
+                self.stopping.set()
+                self.stopping = None
+                self.dmx.untrack_changes()
+
+    def stop(self):
+        with self.subscribers_lock:
+            if self.stopping is not None:
+                self.stopping.set()
+                self.stopping = None
+
+    def run(self, stopping):
+        # each run gets its own values, so a restarted thread doesn't compare against stale ones
+        last_values = {}
+        next_tick = monotonic_time()
+        while not stopping.is_set():
+            next_tick += self.interval
+            try:
+                self.notify(self.take_diff(last_values))
+            except Exception:
+                traceback.print_exc()
+            delay = next_tick - monotonic_time()
+            if delay < 0:
+                # running behind - skip ticks rather than bunching them up
+                next_tick = monotonic_time()
+            else:
+                stopping.wait(delay)
+
+    def take_diff(self, last_values):
+        """Returns the channels whose values have changed since the last tick"""
+        diff = {}
+        for ch, value in self.dmx.take_changes().iteritems():
+            if last_values.get(ch) != value:
+                diff[ch] = value
+        last_values.update(diff)
+        return diff
+
+    def notify(self, diff):
+        if not diff:
+            return
+        with self.subscribers_lock:
+            subscribers = self.subscribers.items()
+        # subscribers to the same channels share the same output
+        formatted = {}
+        for handler, channels in subscribers:
+            key = (channels, handler.input_mode == INPUT_BINARY)
+            if key not in formatted:
+                changes = [(ch, diff[ch]) for ch in sorted(channels.intersection(diff))]
+                formatted[key] = handler.format_changes(changes) if changes else None
+            if formatted[key] is not None:
+                try:
+                    handler.send_output(formatted[key])
+                except socket.error:
+                    # the connection's gone, and unsubscribes as it closes
+                    pass
+
+
+class DmxProtocolMixin(object):
     """
-    Imperial Cinema DMX protocol RequestHandler class.
+    The transport-independent half of a DMX protocol connection.
+
+    Handlers feed it whatever they receive, and implement send_output (for
+    output which isn't a direct response, e.g. ASYNCDONE) and wait_for_runner.
+    send_output is called from other threads, and must not block.
     """
-    def __init__(self, dmx, *args, **kwargs):
+    def init_protocol(self, dmx):
         self.dmx = dmx
         self.async_command_id = 0
+        # async commands finish on the fade scheduler's thread, so these are guarded by async_lock
         self.pending_async_commands = set()
         self.completed_async_commands = {}
-        socketserver.StreamRequestHandler.__init__(self, *args, **kwargs)
-
-    def handle(self):
-        # the ICDMX TCP protocol is line-based
-        # this means that we just eat the input one line at a time
+        self.async_runners = {}
+        self.async_lock = threading.Lock()
         self.parser = DmxCommandParser(self.dmx, self)
-        self.wfile.write("READY (? for help)\n")
+
+        self.input_mode = INPUT_TEXT
+        self.received = ""
+        self.pending_lines = collections.deque()
+        self.stream = None
+
+    def close_protocol(self):
+        """Called once the connection has closed"""
+        self.server.subscriptions.unsubscribe(self)
+        if self.stream is not None:
+            self.leave_stream_mode()
+
+    def greeting(self):
+        return "READY (? for help)\n"
+
+    def feed(self, data):
+        """
+        Takes newly received data (which may be empty, to resume after a deferred command).
+
+        Returns (output, whether to close the connection, runner which must
+        finish before anything else is processed or None).
+        """
+        self.received += data
+        output = []
         while True:
+            if self.input_mode == INPUT_BINARY:
+                output.append(self.process_binary_messages())
+                if self.input_mode == INPUT_BINARY:
+                    return "".join(output), False, None
+            elif self.input_mode == INPUT_STREAM:
+                output.append(self.process_stream_frames())
+                if self.input_mode == INPUT_STREAM:
+                    return "".join(output), False, None
+
+            if "\n" in self.received:
+                complete = self.received.split("\n")
+                self.received = complete.pop()
+                self.pending_lines.extend(complete)
+            out, closing, deferred = self.process_lines(self.pending_lines)
+            output.append(out)
+            if closing or deferred is not None or self.input_mode == INPUT_TEXT:
+                return "".join(output), closing, deferred
+
+            # switched mode part way through: the rest of what we've received isn't text
+            self.received = "".join(line + "\n" for line in self.pending_lines) + self.received
+            self.pending_lines.clear()
+
+    def exception_message(self, ex):
+        if isinstance(ex, DmxProtocolException):
+            return ex.get_short_error()
+        traceback.print_exc()
+        return str(ex)
+
+    def format_exception(self, ex):
+        return "ERROR {}\n".format(self.exception_message(ex))
+
+    def process_line(self, line):
+        """Processes a single command line, returning (output, whether to close the connection)"""
+        metrics = self.dmx.metrics
+        if metrics is None:
+            return self.run_line(line)
+        started = monotonic_time()
+        try:
+            return self.run_line(line)
+        finally:
+            # known commands only, so clients can't fill the metrics up with junk names
+            keyword = line.split(' ', 1)[0]
+            if keyword not in self.parser.command_table[0] and keyword not in self.parser.fading_command_table[0]:
+                keyword = "other"
+            metrics.histogram("command." + keyword).record(monotonic_time() - started)
+
+    def run_line(self, line):
+        try:
+            out = self.parser.process_command(line)
+            if not out:
+                return "OK\n", False
+            return "".join("OK {}\n".format(ln) for ln in out.split('\n')), False
+        except DmxCommandAsync, ex:
+            return self.format_async_pending(ex.command_id), False
+        except DmxCommandDeferred:
+            raise
+        except DmxCommandExit:
+            return "BYE cya\n", True
+        except Exception, ex:
+            return self.format_exception(ex), False
+
+    def process_lines(self, lines):
+        """
+        Processes a batch of command lines (a deque, consumed as they're processed).
+
+        Runs of consecutive set/setm commands are applied with a single
+        set_channels call; each still gets its own response, in order.
+        Processing stops early if a command switches to binary mode.
+        Returns (output, whether to close the connection, runner which must
+        finish before the remaining lines are processed or None).
+        """
+        output = []
+        closing = False
+        deferred = None
+        set_run = [] # indices into output of the responses to coalesced set commands
+        set_channels = {}
+
+        while lines and not closing and self.input_mode == INPUT_TEXT:
+            line = lines.popleft().rstrip()
+            try:
+                channel_set = self.parser.parse_set_command(line)
+            except Exception, ex:
+                output.append(self.format_exception(ex))
+                continue
+            if channel_set is not None:
+                set_channels.update(channel_set)
+                set_run.append(len(output))
+                output.append("OK\n")
+                continue
+
+            self.flush_sets(set_channels, set_run, output)
+            set_channels, set_run = {}, []
             try:
-                out = self.parser.process_command(self.rfile.readline().rstrip())
-                if not out:
-                    self.wfile.write("OK\n")
-                else:
-                    for ln in out.split('\n'):
-                        self.wfile.write("OK {}\n".format(ln))
-            except DmxCommandAsync, ex:
-                self.wfile.write("ASYNCPENDING {}\n".format(ex.command_id))
-                if ex.command_id in self.pending_async_commands:
-                    self.pending_async_commands.remove(ex.command_id)
-                    self.wfile.write("ASYNCDONE {}\n".format(ex.command_id))
-                else:
-                    self.pending_async_commands.add(ex.command_id)
-            except DmxCommandExit:
-                self.wfile.write("BYE cya\n")
+                out, closing = self.process_line(line)
+            except DmxCommandDeferred, ex:
+                deferred = ex.runner
+                break
+            output.append(out)
+
+        self.flush_sets(set_channels, set_run, output)
+        return "".join(output), closing, deferred
+
+    def flush_sets(self, set_channels, set_run, output):
+        if not set_channels:
+            return
+        metrics = self.dmx.metrics
+        if metrics is not None:
+            started = monotonic_time()
+        try:
+            self.dmx.set_channels(set_channels)
+        except Exception, ex:
+            error = self.format_exception(ex)
+            for i in set_run:
+                output[i] = error
+        if metrics is not None:
+            metrics.histogram("command.set_batch").record(monotonic_time() - started)
+            metrics.counter("command.sets").add(len(set_run))
+
+    def enter_binary_mode(self):
+        self.input_mode = INPUT_BINARY
+
+    def process_binary_messages(self):
+        """Processes every complete binary message received, returning their responses"""
+        output = []
+        received = self.received
+        offset = 0
+        while self.input_mode == INPUT_BINARY and len(received) - offset >= BINARY_HEADER.size:
+            length, msg_type = BINARY_HEADER.unpack_from(received, offset)
+            start = offset + BINARY_HEADER.size
+            if len(received) - start < length:
+                break
+            offset = start + length
+            output.append(self.process_binary_message(msg_type, received[start:offset]))
+        self.received = received[offset:]
+        return "".join(output)
+
+    def process_binary_message(self, msg_type, payload):
+        try:
+            if msg_type == BINARY_SET_FRAME:
+                self.dmx.set_channel_range(self.dmx.min_channel, payload)
+            elif msg_type == BINARY_SET_RANGE:
+                start, = BINARY_RANGE.unpack_from(payload)
+                self.dmx.set_channel_range(start, payload[BINARY_RANGE.size:])
+            elif msg_type == BINARY_GET_RANGE:
+                start, count = BINARY_GET.unpack(payload)
+                return binary_message(BINARY_DATA, BINARY_RANGE.pack(start) + self.dmx.get_channel_range(start, count))
+            elif msg_type == BINARY_FADE:
+                self.binary_fade(payload)
+            elif msg_type == BINARY_TEXT:
+                self.input_mode = INPUT_TEXT
+            else:
+                raise DmxCommandInvalid()
+            return binary_message(BINARY_OK)
+        except DmxCommandAsync, ex:
+            return self.format_async_pending(ex.command_id)
+        except Exception, ex:
+            return binary_message(BINARY_ERROR, self.exception_message(ex))
+
+    def enter_stream_mode(self, priority):
+        self.stream = self.server.streams.open(self.dmx, priority)
+        self.input_mode = INPUT_STREAM
+
+    def leave_stream_mode(self):
+        stream, self.stream = self.stream, None
+        self.server.streams.close(stream)
+        self.input_mode = INPUT_TEXT
+
+    def process_stream_frames(self):
+        """Applies the latest complete frame received (dropping older ones); returns output only when the stream ends"""
+        frames = []
+        ended = False
+        received = self.received
+        offset = 0
+        while len(received) - offset >= STREAM_HEADER.size:
+            length, = STREAM_HEADER.unpack_from(received, offset)
+            start = offset + STREAM_HEADER.size
+            if len(received) - start < length:
+                break
+            offset = start + length
+            if not length:
+                ended = True
                 break
-            except DmxProtocolException, ex:
-                self.wfile.write("ERROR {}\n".format(ex.get_short_error()))
+            frames.append(received[start:offset])
+        self.received = received[offset:]
+
+        if frames:
+            try:
+                self.stream.apply(frames)
             except Exception, ex:
-                traceback.print_exc()
-                self.wfile.write("ERROR {}\n".format(str(ex)))
+                # there's nobody to tell, but count it
+                self.exception_message(ex)
+                self.stream.errors += 1
+        if ended:
+            self.leave_stream_mode()
+            return "OK STREAM ENDED\n"
+        return ""
+
+    def binary_fade(self, payload):
+        if not payload or len(payload) % BINARY_KEYFRAME.size:
+            raise DmxCommandInvalid()
+        change = self.dmx.new_change()
+        for offset in range(0, len(payload), BINARY_KEYFRAME.size):
+            time, channel, value, easing = BINARY_KEYFRAME.unpack_from(payload, offset)
+            if easing >= len(BINARY_EASINGS):
+                raise DmxCommandInvalid()
+            self.dmx.validate_channel(self.dmx.normalize_channel(channel))
+            change.set(time, channel, value, BINARY_EASINGS[easing])
+        change.execute()
+        raise DmxCommandAsync(self.track_async_runner(change.runner))
 
     def get_async_command_id(self):
         self.async_command_id += 1
         return self.async_command_id
 
-    def say_async_done(self, command_id):
-        reason = self.completed_async_commands[command_id]
-        if not reason:
-            self.wfile.write("ASYNCDONE {}\n".format(command_id))
+    def track_async_runner(self, runner):
+        """Gives a running fade an async command id (which it can be controlled by), returning it"""
+        command_id = self.get_async_command_id()
+        with self.async_lock:
+            self.async_runners[command_id] = runner
+        runner.when_done(lambda _: self.async_runner_done(command_id, runner))
+        return command_id
+
+    def async_runner_done(self, command_id, runner):
+        with self.async_lock:
+            self.async_runners.pop(command_id, None)
+        self.async_done(command_id, "CANCELLED" if runner.cancelled else None)
+
+    def get_async_runner(self, command_id):
+        with self.async_lock:
+            runner = self.async_runners.get(command_id)
+        if runner is None:
+            raise ValueError("No fade running as {}".format(command_id))
+        return runner
+
+    def format_async_pending(self, command_id):
+        if self.input_mode == INPUT_BINARY:
+            output = binary_message(BINARY_ASYNCPENDING, BINARY_COMMAND_ID.pack(command_id))
         else:
-            for ln in reason.split('\n'):
-                self.wfile.write("ASYNCDONE {} {}\n".format(command_id, ln))
+            output = "ASYNCPENDING {}\n".format(command_id)
+        with self.async_lock:
+            if command_id in self.pending_async_commands:
+                # it finished before we'd said it was pending
+                self.pending_async_commands.remove(command_id)
+                output += self.format_async_done(command_id)
+            else:
+                self.pending_async_commands.add(command_id)
+        return output
+
+    def format_async_done(self, command_id):
+        reason = self.completed_async_commands.pop(command_id)
+        if self.input_mode == INPUT_BINARY:
+            return binary_message(BINARY_ASYNCDONE, BINARY_COMMAND_ID.pack(command_id) + (reason or ""))
+        if not reason:
+            return "ASYNCDONE {}\n".format(command_id)
+        return "".join("ASYNCDONE {} {}\n".format(command_id, ln) for ln in reason.split('\n'))
+
+    def format_changes(self, changes):
+        if self.input_mode == INPUT_BINARY:
+            # subscriptions are to plain channel numbers, which multi-universe controllers key as (universe, channel)
+            return binary_message(BINARY_CHANGED, "".join(
+                BINARY_CHANGE.pack(ch[1] if isinstance(ch, tuple) else ch, value) for ch, value in changes))
+        return "CHANGED {}\n".format(",".join("{}:{}".format(ch, value) for ch, value in changes))
 
     def async_done(self, command_id, reason=None):
-        self.completed_async_commands[command_id] = reason
-        if command_id in self.pending_async_commands:
-            self.pending_async_commands.remove(command_id)
-            self.say_async_done(command_id)
-        else:
-            self.pending_async_commands.add(command_id)
+        # called on the runner's thread: send_output must only queue the output, never block on the client
+        output = None
+        with self.async_lock:
+            self.completed_async_commands[command_id] = reason
+            if command_id in self.pending_async_commands:
+                self.pending_async_commands.remove(command_id)
+                output = self.format_async_done(command_id)
+            else:
+                self.pending_async_commands.add(command_id)
+        if output is not None:
+            self.send_output(output)
+
+    def send_output(self, output):
+        raise NotImplementedError("Subclasses should override this method and implement it")
+
+    def wait_for_runner(self, runner):
+        raise NotImplementedError("Subclasses should override this method and implement it")
+
+
+class DmxOutputQueue(object):
+    """Output waiting for a connection's writer thread, bounded by its total size rather than its number of chunks"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.cv = threading.Condition()
+
+    def put(self, chunk, block=True):
+        """Queues chunk (None ends the writer), waiting while the queue is full; returns False if it's full and block is False"""
+        with self.cv:
+            # the end is always let in, so the writer can always be stopped
+            while chunk is not None and self.size >= self.max_bytes:
+                if not block:
+                    return False
+                self.cv.wait()
+            self.chunks.append(chunk)
+            if chunk is not None:
+                self.size += len(chunk)
+            self.cv.notify_all()
+        return True
+
+    def get_all(self):
+        """Waits for output, then takes everything queued"""
+        with self.cv:
+            while not self.chunks:
+                self.cv.wait()
+            chunks = list(self.chunks)
+            self.chunks.clear()
+            self.size = 0
+            self.cv.notify_all()
+        return chunks
+
+
+class DmxTcpHandler(DmxProtocolMixin, socketserver.StreamRequestHandler):
+    """
+    Imperial Cinema DMX protocol RequestHandler class.
+    """
+    output_queue_bytes = OUTPUT_QUEUE_BYTES
+
+    def __init__(self, dmx, *args, **kwargs):
+        self.init_protocol(dmx)
+        # everything written to the client goes through here, to the writer thread
+        self.outbound = DmxOutputQueue(self.output_queue_bytes)
+        socketserver.StreamRequestHandler.__init__(self, *args, **kwargs)
+
+    def handle(self):
+        # the ICDMX TCP protocol is line-based (unless switched to binary)
+        # we take whatever has arrived, process it as a batch and write all
+        # of the responses at once
+        writer = threading.Thread(target=self.write_output)
+        writer.daemon = True
+        writer.start()
+        self.outbound.put(self.greeting())
+        try:
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                out, closing, _ = self.feed(data)
+                if out:
+                    # blocks while the queue is full, so a client that doesn't read stops being read from
+                    self.outbound.put(out)
+                if closing:
+                    break
+        finally:
+            self.close_protocol()
+            self.outbound.put(None)
+            writer.join()
+
+    def write_output(self):
+        """The writer thread: the only thing that writes to the socket, so a slow client only holds up itself"""
+        failed = False
+        while True:
+            # write everything that's queued up in one go
+            chunks = self.outbound.get_all()
+            finished = None in chunks
+            if finished:
+                chunks = chunks[:chunks.index(None)]
+            if chunks and not failed:
+                try:
+                    self.wfile.write("".join(chunks))
+                except socket.error:
+                    # the client's gone: discard the rest, and stop the reader too
+                    failed = True
+                    self.drop_client()
+            if finished:
+                return
+
+    def drop_client(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def send_output(self, output):
+        # called from other threads (ASYNCDONE, CHANGED), which mustn't block - so a client this far behind is dropped
+        if not self.outbound.put(output, block=False):
+            self.drop_client()
+
+    def wait_for_runner(self, runner):
+        runner.join()
 
 
 class DmxTcpServer(socketserver.TCPServer):
@@ -252,20 +1018,168 @@ class DmxTcpServer(socketserver.TCPServer):
 
     def __init__(self, dmx, *args, **kwargs):
         self.dmx = dmx
+        self.streams = DmxStreamRegistry()
+        self.subscriptions = DmxChangeNotifier(dmx, kwargs.pop("subscription_rate", SUBSCRIPTION_DEFAULT_RATE))
+        # a cuelist.DmxCueList, for go
+        self.cues = kwargs.pop("cues", None)
         socketserver.TCPServer.__init__(self, *args, **kwargs)
 
+    def server_close(self):
+        self.subscriptions.stop()
+        socketserver.TCPServer.server_close(self)
+
     def finish_request(self, request, client_address):
         self.RequestHandlerClass(self.dmx, request, client_address, self)
 
 
+class ThreadedDmxTcpServer(socketserver.ThreadingMixIn, DmxTcpServer):
+    """Serves each connection from its own thread"""
+    daemon_threads = True
+
+
+class DmxLoopWaker(asyncore.dispatcher):
+    """Lets other threads (e.g. the fade scheduler) run functions on an asyncore loop"""
+    def __init__(self, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.wake_socket, read_socket = socket.socketpair()
+        self.wake_socket.setblocking(False)
+        self.set_socket(read_socket)
+        self.calls = collections.deque()
+
+    def call_soon(self, func):
+        self.calls.append(func)
+        try:
+            self.wake_socket.send("x")
+        except socket.error:
+            # the socket buffer is full of wakeups already
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.calls:
+            self.calls.popleft()()
+
+    def handle_close(self):
+        self.close()
+        self.wake_socket.close()
+
+
+class DmxAsyncHandler(DmxProtocolMixin, asynchat.async_chat):
+    """
+    Imperial Cinema DMX protocol over an asyncore event loop: one thread serves every connection.
+    """
+    def __init__(self, dmx, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.init_protocol(dmx)
+        self.server = server
+        # we split lines ourselves, so that everything read at once is processed as a batch
+        self.set_terminator(None)
+        # set while a blocking command is running: later input waits until it's done
+        self.deferred = False
+        self.push(self.greeting())
+
+    def collect_incoming_data(self, data):
+        if self.deferred:
+            self.received += data
+        else:
+            self.process_received(data)
+
+    def process_received(self, data=""):
+        if not self.connected:
+            return
+        out, closing, deferred = self.feed(data)
+        if out:
+            self.push(out)
+        if deferred is not None:
+            self.deferred = True
+            deferred.when_done(lambda _: self.server.waker.call_soon(self.deferred_done))
+        if closing:
+            self.pending_lines.clear()
+            self.close_when_done()
+
+    def deferred_done(self):
+        self.deferred = False
+        if self.connected:
+            self.push("OK\n")
+            self.process_received()
+
+    def send_output(self, output):
+        # may be called from any thread
+        self.server.waker.call_soon(lambda: self.push_if_connected(output))
+
+    def handle_close(self):
+        self.close_protocol()
+        self.close()
+
+    def push_if_connected(self, output):
+        if self.connected:
+            self.push(output)
+
+    def wait_for_runner(self, runner):
+        raise DmxCommandDeferred(runner)
+
+
+class AsyncDmxServer(asyncore.dispatcher):
+    """Serves any number of connections from a single asyncore event loop thread"""
+    def __init__(self, dmx, server_address, request_queue_size=64, subscription_rate=SUBSCRIPTION_DEFAULT_RATE, cues=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.dmx = dmx
+        self.streams = DmxStreamRegistry()
+        self.subscriptions = DmxChangeNotifier(dmx, subscription_rate)
+        self.cues = cues
+        self.waker = DmxLoopWaker(self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.keep_going = True
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            DmxAsyncHandler(self.dmx, pair[0], self)
+
+    def serve_forever(self, poll_interval=0.5):
+        while self.keep_going:
+            asyncore.loop(timeout=poll_interval, map=self.map, count=1)
+        asyncore.close_all(map=self.map)
+
+    def shutdown(self):
+        self.subscriptions.stop()
+        def stop():
+            self.keep_going = False
+        self.waker.call_soon(stop)
+
+
 if __name__ == '__main__':
     HOST, PORT = "localhost", 9090
 
     import sys
     sys.path.append("../lib/")
 
-    import dmx, dummyparallel
-    dmdmx = dmx.ManolatorDmxController(dummyparallel.DummyParallel())
+    # single (one connection at a time), threaded or async; then optionally a show file (or -)
+    # how often (in seconds) to dump metrics to stderr (or -), and a file to keep the universe in across restarts
+    mode = sys.argv[1] if len(sys.argv) > 1 else "threaded"
+    show = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != "-" else None
+    stats_interval = float(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] != "-" else None
+    snapshot_path = sys.argv[4] if len(sys.argv) > 4 else None
+
+    import cuelist, dmx, dummyparallel, metrics
+    dmx_metrics = metrics.DmxMetrics()
+    if stats_interval:
+        dmx_metrics.start_dump(stats_interval)
+    dmdmx = dmx.ManolatorDmxController(dummyparallel.DummyParallel(), snapshot_path=snapshot_path, metrics=dmx_metrics)
+    cues = cuelist.DmxCueList.load(show, dmdmx) if show else None
 
-    server = DmxTcpServer(dmdmx, (HOST, PORT), DmxTcpHandler)
+    if mode == "async":
+        server = AsyncDmxServer(dmdmx, (HOST, PORT), cues=cues)
+    elif mode == "single":
+        server = DmxTcpServer(dmdmx, (HOST, PORT), DmxTcpHandler, cues=cues)
+    else:
+        server = ThreadedDmxTcpServer(dmdmx, (HOST, PORT), DmxTcpHandler, cues=cues)
     server.serve_forever()
\ No newline at end of file
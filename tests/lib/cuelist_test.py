@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+
+import backends
+import cuelist
+import dmx
+
+SHOW = {
+    "cues": [
+        {"number": 1, "name": "House to half", "keyframes": [
+            {"time": 0, "channel": 1, "value": 255},
+            {"time": 0.05, "channel": 1, "value": 128, "easing": "ease_out"},
+        ]},
+        {"number": "1.5", "priority": 2, "keyframes": [
+            {"time": 0, "channel": 2, "value": 0},
+            {"time": 0.05, "channel": 2, "value": 60},
+        ]},
+        {"number": 2, "bake": 100, "keyframes": [
+            {"time": 0, "channel": 3, "value": 10},
+            {"time": 0.05, "channel": 3, "value": 20},
+        ]},
+    ]
+}
+
+def test_load_and_go():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "show.json")
+        with open(path, "wb") as f:
+            json.dump(SHOW, f)
+        mn = dmx.ManolatorDmxController(backends.RecordingOutput(), fade_interval=0.005)
+        cues = cuelist.DmxCueList.load(path, mn)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    assert len(cues) == 3 and cues[1].name == "House to half" and cues["1.5"].duration == 0.05
+    compiled = cues[1].modification.compiled
+    for number in (None, None, None):
+        cue, runner = cues.go(mn, number)
+        assert runner.join(1)
+    assert mn.get_channels([1, 2, 3]) == {1: 128, 2: 60, 3: 20}
+    try:
+        cues.go(mn)
+    except IndexError:
+        pass
+    else:
+        assert False, "expected IndexError"
+
+    # firing again shares the compiled curves
+    cue, runner = cues.go(mn, 1)
+    assert runner.join(1)
+    assert cue.modification.compiled is compiled
+    assert isinstance(cues.go(mn, 2)[1], cuelist.BakedCueRunner)
+
+def test_invalid_shows_rejected():
+    mn = dmx.ManolatorDmxController(backends.RecordingOutput())
+    for show in [
+        {"cues": [{"number": 1, "keyframes": [{"time": 0, "channel": 300, "value": 1}]}]},
+        {"cues": [{"number": 1, "takeover": "steal", "keyframes": [{"time": 0, "channel": 1, "value": 1}]}]},
+        {"cues": [{"number": 1, "keyframes": [{"time": 0, "channel": 1, "value": 1}]}] * 2},
+    ]:
+        try:
+            cuelist.DmxCueList.from_dict(show, mn)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError for %r" % (show,)
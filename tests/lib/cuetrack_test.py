@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+
+import cuetrack
+import dmx
+
+def make_modification():
+    mod = dmx.DmxModification()
+    mod.set(time=0, channel=3, value=0)
+    mod.set(time=1, channel=3, value=255, easing="ease_in_out")
+    mod.set(time=0.5, channel=9, value=40)
+    mod.set(time=2, channel=9, value=200)
+    mod.lock()
+    return mod
+
+def test_bake_matches_runner():
+    mod = make_modification()
+    cue = cuetrack.BakedCue.bake(mod, rate=20)
+    runner = dmx.DmxModificationRunner(None, mod)
+    assert cue.frame_count == 41
+    for frame in range(cue.frame_count):
+        assert cue.values_at_frame(frame) == runner.step_at(frame / 20.0)
+
+def test_save_and_load():
+    mod = make_modification()
+    cue = cuetrack.BakedCue.bake(mod, rate=20)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "cue.bin")
+        cue.save(path)
+        loaded = cuetrack.BakedCue.load(path)
+        assert loaded.channels == [3, 9]
+        assert loaded.frame_bytes(0, loaded.frame_count) == cue.frame_bytes(0, cue.frame_count)
+        for frame in range(cue.frame_count):
+            assert loaded.values_at_frame(frame) == cue.values_at_frame(frame)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_baked_playback():
+    mod = make_modification()
+    cue = cuetrack.BakedCue.bake(mod, rate=20)
+    cue.rate *= 100 # play it back quickly
+    cue.duration /= 100
+    runner = cue.execute(dmx.DummyDmxController(fade_interval=0.001), interval=0.001)
+    assert runner.join(1)
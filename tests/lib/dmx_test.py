@@ -1,8 +1,19 @@
+import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import backends
 import dmx
 import dummyparallel
+import outputprocess
+import snapshot
 
 def setup_parallel():
-    return dummyparallel.DummyParallel()
+    return backends.RecordingOutput()
 
 def test_basic():
     mn = dmx.ManolatorDmxController(setup_parallel())
@@ -47,4 +58,587 @@ def test_fading():
     mod.set(time=4*factor, channel=74, value=60)
     mod.set(time=5*factor, channel=73, value=255, easing="ease_in_out")
     mod.execute(interval=factor*0.1)
-    mod.runner.join()
\ No newline at end of file
+    mod.runner.join()
+
+def test_fading_shares_scheduler():
+    factor = 0.01
+
+    dmdmx = dmx.DummyDmxController(fade_interval=factor*0.1)
+    threads_before = threading.active_count()
+    done = []
+    mods = []
+    for ch in range(1, 21):
+        mod = dmdmx.new_change()
+        mod.set(time=0, channel=ch, value=0)
+        mod.set(time=2*factor, channel=ch, value=255)
+        mod.execute()
+        mod.runner.when_done(done.append)
+        mods.append(mod)
+    assert threading.active_count() == threads_before + 1
+    for mod in mods:
+        assert mod.runner.join(1)
+    assert len(done) == 20
+
+
+def test_fading_applies_masked_frames():
+    if dmx.numpy is None:
+        return
+    mn = dmx.ManolatorDmxController(setup_parallel(), fade_interval=0.001)
+    mod = mn.new_change()
+    for ch in range(1, 41):
+        mod.set(time=0, channel=ch, value=0)
+        mod.set(time=0.02, channel=ch, value=ch * 5)
+    mod.execute(interval=0.001)
+    assert mod.runner.can_step_masked()
+    assert mod.runner.join(1)
+    assert mn.get_channel_range(1, 41) == bytes(bytearray(ch * 5 for ch in range(1, 41)) + b"\x00")
+
+def reference_step_at(mod, t):
+    # the original keyframe scan which the compiled curves replace
+    output = {}
+    for ch in mod.using_channels:
+        chts = [ts for ts in sorted(mod.time_values) if ch in mod.time_values[ts]]
+        before = [ts for ts in chts if ts < t]
+        after = [ts for ts in chts if ts >= t]
+        if not before or not after:
+            continue
+        last_time, next_time = max(before), min(after)
+        last_value, next_value = mod.time_values[last_time][ch], mod.time_values[next_time][ch]
+        pct = float(t - last_time) / float(next_time - last_time)
+        val = dmx.EASINGS[next_value["easing"]](pct, last_value["value"], next_value["value"])
+        output[ch] = int(round(val))
+    return output
+
+def test_compiled_curves_match_keyframe_scan():
+    mod = dmx.DmxModification()
+    easings = sorted(dmx.EASINGS.keys())
+    for ch in range(1, 11):
+        for i in range(0, 40, ch % 3 + 1):
+            mod.set(time=i + ch * 0.1, channel=ch, value=(i * 37 + ch * 11) % 256, easing=easings[(i + ch) % len(easings)])
+    mod.lock()
+    runner = dmx.DmxModificationRunner(dmx.DummyDmxController(), mod)
+
+    # forwards (cursor path), then backwards and jumping around (bisect path)
+    times = [i * 0.05 for i in range(850)]
+    for t in times + times[::-7] + [3.3, 0, 41, 12.25]:
+        assert runner.step_at(t) == reference_step_at(mod, t)
+
+def test_unknown_easing_rejected():
+    mod = dmx.DmxModification()
+    try:
+        mod.set(time=1, channel=1, value=255, easing="bouncy")
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+def test_numpy_matches_python():
+    if dmx.numpy is None:
+        return
+    mod = dmx.DmxModification()
+    easings = sorted(dmx.EASINGS.keys())
+    for ch in range(1, 257):
+        for i in range(0, 12, ch % 4 + 1):
+            mod.set(time=i * 0.5 + (ch % 7) * 0.1, channel=ch, value=(i * 53 + ch * 7) % 256, easing=easings[(i + ch) % len(easings)])
+    mod.lock()
+    controller = dmx.DummyDmxController()
+    py_runner = dmx.DmxModificationRunner(controller, mod, use_numpy=False)
+    np_runner = dmx.DmxModificationRunner(controller, mod, use_numpy=True)
+    for i in range(0, 700):
+        t = i * 0.01
+        expected = py_runner.step_at(t)
+        assert np_runner.step_at(t) == expected
+        frame, mask = np_runner.frame_at(t)
+        assert dict((ch, int(frame[ch])) for ch in range(len(mask)) if mask[ch]) == expected
+        mask, frame = np_runner.masked_frame_at(t)
+        assert dict((ch, frame[ch]) for ch in mask.channels) == expected
+
+def test_numpy_and_python_reject_the_same_fades():
+    controller = dmx.DummyDmxController()
+    for channel, value in ((5, 300), (5, -1), (300, 10)):
+        mod = dmx.DmxModification()
+        for ch in range(1, 40):
+            mod.set(time=0, channel=ch, value=0).set(time=1, channel=ch, value=100)
+        mod.set(time=2, channel=channel, value=value)
+        mod.lock()
+        for use_numpy in (False, True):
+            if use_numpy and dmx.numpy is None:
+                continue
+            try:
+                dmx.DmxModificationRunner(controller, mod, use_numpy=use_numpy)
+            except ValueError:
+                pass
+            else:
+                assert False, "expected ValueError"
+
+def test_output_frame():
+    p = setup_parallel()
+    mn = dmx.ManolatorDmxController(p, default_value=7, starting_values={1: 11, 256: 22})
+    mn.start()
+    try:
+        mn.set_channel(100, 33)
+        frame = p.wait_for_frame(lambda frame: frame[99] == 33)
+        assert frame is not None
+    finally:
+        mn.stop()
+    assert len(frame) == 256
+    assert frame[0] == 11
+    assert frame[99] == 33
+    assert frame[255] == 22
+    assert frame[1] == 7
+    assert mn.get_channel(2) == 7
+
+def test_set_does_not_wait_for_frame_output():
+    in_frame = threading.Event()
+    class SlowOutput(backends.RecordingOutput):
+        def write_frame(self, frame):
+            in_frame.set()
+            time.sleep(0.1)
+            super(SlowOutput, self).write_frame(frame)
+
+    mn = dmx.ManolatorDmxController(SlowOutput())
+    mn.start()
+    try:
+        assert in_frame.wait(3)
+        # the output thread is now part way through writing its frame
+        started = time.time()
+        mn.set_channel(6, 60)
+        assert time.time() - started < 0.05
+    finally:
+        mn.stop()
+
+def test_refresh_rate():
+    p = setup_parallel()
+    mn = dmx.ManolatorDmxController(p, frame_rate=20, keepalive_rate=0.5)
+    mn.start()
+    try:
+        # the first frame goes out straight away
+        assert p.wait_for_frame(timeout=1) is not None
+        # continuous writes are limited to the frame rate
+        started = time.time()
+        value = 0
+        while time.time() - started < 0.5:
+            value = (value + 1) % 256
+            mn.set_channel(1, value)
+            time.sleep(0.001)
+        assert 5 <= len(p.frames) <= 13
+        # unchanged writes don't produce frames
+        time.sleep(0.1)
+        frame_count = len(p.frames)
+        for _ in range(10):
+            mn.set_channel(1, value)
+            time.sleep(0.01)
+        assert len(p.frames) == frame_count
+    finally:
+        mn.stop()
+
+def test_parallel_port_output():
+    captured = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, captured
+    try:
+        backends.ParallelPortOutput(dummyparallel.DummyParallel(), reset_time=0).write_frame(bytearray([1, 2]))
+    finally:
+        sys.stdout = stdout
+    assert captured.getvalue() == "0\n[1][0]1<>2<>"
+
+def test_stream_output():
+    stream = StringIO.StringIO()
+    mn = dmx.ManolatorDmxController(backends.StreamOutput(stream), starting_values={1: 65, 3: 67})
+    mn.start()
+    try:
+        deadline = time.time() + 3
+        while len(stream.getvalue()) < dmx.DMX_MAX_CHANNEL and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        mn.stop()
+    assert stream.getvalue()[:3] == "A\x00C"
+
+def read_frames(f, predicate, size=dmx.DMX_MAX_CHANNEL, limit=100):
+    for _ in range(limit):
+        frame = bytearray(f.read(size))
+        if len(frame) < size:
+            return None
+        if predicate(frame):
+            return frame
+    return None
+
+def test_output_process():
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb")
+    output = backends.StreamOutput(os.fdopen(write_fd, "wb"))
+    mn = dmx.ManolatorDmxController(output, frame_rate=50, output_process=True, starting_values={1: 10})
+    mn.start()
+    try:
+        output.close() # the child has its own copy
+        assert read_frames(reader, lambda frame: frame[0] == 10) is not None
+        mn.set_channels({2: 20, 256: 30})
+        mn.fill_channel_range(100, 3, 40)
+        frame = read_frames(reader, lambda frame: frame[255] == 30 and frame[100] == 40)
+        assert frame is not None and frame[:2] == b"\x0a\x14" and frame[99:102] == b"\x28\x28\x28"
+        assert mn.output_process.is_alive()
+    finally:
+        mn.stop()
+    assert not mn.output_process.is_alive()
+    reader.close()
+
+def raises_died(mn):
+    try:
+        mn.set_channel(1, 20)
+    except RuntimeError, ex:
+        return str(ex) == "Parallel port has died!"
+    return False
+
+def test_output_process_death_is_noticed():
+    mn = dmx.ManolatorDmxController(backends.StreamOutput(open(os.devnull, "wb")), frame_rate=50, output_process=True)
+    mn.start()
+    try:
+        mn.set_channel(1, 10)
+        mn.output_process.terminate()
+        assert mn.parallel_ending_event.wait(3)
+        assert raises_died(mn)
+    finally:
+        mn.stop()
+    assert not mn.output_process.is_alive()
+
+class FailingOutput(backends.BaseDmxOutput):
+    def write_frame(self, frame):
+        raise IOError("Unplugged")
+
+def test_output_process_failure_is_noticed():
+    mn = dmx.ManolatorDmxController(FailingOutput(), frame_rate=50, output_process=True)
+    mn.start()
+    try:
+        assert mn.parallel_ending_event.wait(3)
+        assert mn.output_process.exitcode != 0
+        assert raises_died(mn)
+    finally:
+        mn.stop()
+
+def test_shared_universe_reads_whole_writes():
+    universe = outputprocess.SharedUniverse(4)
+    universe.write(b"\x01\x02\x03\x04")
+    frame = bytearray(4)
+    assert universe.read(frame) == 2 and frame == b"\x01\x02\x03\x04"
+    assert universe.running
+    universe.running = False
+    assert not universe.running and universe.sequence() == 2
+
+def test_shared_universe_keeps_running_flag_during_writes():
+    universe = outputprocess.SharedUniverse(512)
+    data = bytearray(512)
+    for _ in range(50):
+        universe.running = True
+        writing = threading.Event()
+        def write():
+            for i in range(2000):
+                universe.write(data)
+                if i == 10:
+                    writing.set()
+        writer = threading.Thread(target=write)
+        writer.start()
+        writing.wait()
+        universe.running = False
+        writer.join()
+        assert not universe.running
+
+def test_output_process_stops_during_writes():
+    output = backends.StreamOutput(open(os.devnull, "wb"))
+    mn = dmx.ManolatorDmxController(output, frame_rate=50, output_process=True)
+    mn.start()
+    stopping = threading.Event()
+    def write():
+        value = 0
+        while not stopping.is_set():
+            value = (value + 1) % 256
+            try:
+                mn.apply_channels({1: value, 2: value})
+            except RuntimeError:
+                # stopped under us
+                return
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        time.sleep(0.1)
+        started = time.time()
+        mn.stop()
+        assert time.time() - started < 2
+        assert not mn.output_process.is_alive()
+    finally:
+        stopping.set()
+        writer.join()
+
+def test_multi_universe():
+    outputs = [setup_parallel(), setup_parallel()]
+    universes = [dmx.ManolatorDmxController(output, channel_count=dmx.DMX_UNIVERSE_SIZE) for output in outputs]
+    mu = dmx.MultiUniverseDmxController(universes, starting_values={"2.512": 20})
+    mu.set_channels({"1.5": 10, 7: 30, (2, 1): 40})
+    assert mu.get_channel("2.512") == 20
+    assert mu.get_channels(["1.5", 7, "2.1"]) == {(1, 5): 10, (1, 7): 30, (2, 1): 40}
+    assert universes[0].get_channel(5) == 10
+    for bad in ["3.1", "1.513", "2.0", "x.1"]:
+        try:
+            mu.set_channel(bad, 1)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError for %r" % (bad,)
+
+    mod = mu.new_change()
+    mod.set(time=0, channel="2.3", value=0)
+    mod.set(time=0.02, channel="2.3", value=200)
+    mu.start()
+    try:
+        mod.execute(interval=0.001)
+        assert mod.runner.join(1)
+        assert mu.get_channel("2.3") == 200
+        frame = outputs[1].wait_for_frame(lambda frame: frame[2] == 200)
+        assert frame is not None and len(frame) == 512 and frame[511] == 20
+        assert outputs[0].wait_for_frame(lambda frame: frame[4] == 10) is not None
+    finally:
+        mu.stop()
+
+def test_multi_universe_fades():
+    universes = [dmx.ManolatorDmxController(setup_parallel()) for _ in range(2)]
+    mu = dmx.MultiUniverseDmxController(universes, fade_interval=0.005)
+    mod = mu.new_change()
+    # enough channels for the numpy path, which can't use masks across universes
+    for ch in range(1, 41):
+        mod.set(time=0, channel=ch, value=0).set(time=0.02, channel=ch, value=ch * 5)
+    mod.execute(interval=0.005)
+    assert not mod.runner.can_step_masked()
+    assert mod.runner.join(1) and not mod.runner.cancelled
+    assert universes[0].get_channel_range(1, 40) == bytes(bytearray(ch * 5 for ch in range(1, 41)))
+    mu.stop_fade_scheduler()
+
+def test_channel_ranges():
+    mn = dmx.ManolatorDmxController(setup_parallel(), default_value=3)
+    mn.set_channel_range(10, b"\x01\x02\x03")
+    assert mn.get_channels([9, 10, 11, 12, 13]) == {9: 3, 10: 1, 11: 2, 12: 3, 13: 3}
+    assert mn.get_channel_range(9, 5) == b"\x03\x01\x02\x03\x03"
+    for start, count in [(0, 1), (255, 3), (1, 0)]:
+        try:
+            mn.get_channel_range(start, count)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError for %r" % ((start, count),)
+
+    dm = dmx.DummyDmxController()
+    assert dm.get_channel_range(1, 3) == b"\x00\x00\x00"
+
+def test_bulk_operations():
+    mn = dmx.ManolatorDmxController(setup_parallel(), default_value=3)
+    mn.fill_channel_range(5, 4, 200)
+    assert mn.get_channel_range(4, 6) == b"\x03\xc8\xc8\xc8\xc8\x03"
+    for args in [(0, 4, 1), (254, 4, 1), (5, 4, 256)]:
+        try:
+            mn.fill_channel_range(*args)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError for %r" % (args,)
+
+    mask = mn.channel_mask([10, 12, 11, 20, 256])
+    assert mask.runs == [(10, 13), (20, 21), (256, 257)]
+    frame = bytearray(range(256)) + b"\x05"
+    mn.apply_mask(mask, frame)
+    assert mn.get_channels([9, 10, 11, 12, 13, 20, 256]) == {9: 3, 10: 10, 11: 11, 12: 12, 13: 3, 20: 20, 256: 5}
+    try:
+        mn.channel_mask([257])
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+    # with a layer open, masks are merged like any other set
+    layer = mn.open_layer("stream", priority=1)
+    layer.set_channels({10: 1})
+    mn.apply_mask(mask, bytearray([99]) * 257)
+    assert mn.get_channels([10, 11]) == {10: 1, 11: 99}
+    layer.release()
+    assert mn.get_channel(10) == 99
+
+def test_fade_takeover():
+    mn = dmx.ManolatorDmxController(setup_parallel(), fade_interval=0.005)
+    old = mn.new_change()
+    old.set(time=0, channel=1, value=0).set(time=0, channel=2, value=0)
+    old.set(time=0.3, channel=1, value=100).set(time=0.3, channel=2, value=100)
+    old.execute(interval=0.005)
+    time.sleep(0.05)
+    # takes channel 2 over: the old fade carries on with channel 1
+    new = mn.new_change()
+    new.set(time=0, channel=2, value=200).set(time=0.05, channel=2, value=200)
+    new.execute(interval=0.005)
+    assert new.runner.join(1) and old.runner.join(1)
+    assert not old.runner.cancelled
+    assert mn.get_channels([1, 2]) == {1: 100, 2: 200}
+
+    old = mn.new_change()
+    old.set(time=0, channel=3, value=0).set(time=0, channel=4, value=0)
+    old.set(time=5, channel=3, value=100).set(time=5, channel=4, value=100)
+    old.execute(interval=0.005)
+    new = mn.new_change()
+    new.set(time=0, channel=4, value=50).set(time=0.02, channel=4, value=50)
+    new.execute(interval=0.005, takeover=dmx.DMX_TAKEOVER_CANCEL)
+    assert old.runner.join(1) and old.runner.cancelled
+    assert new.runner.join(1)
+    assert mn.get_channel(4) == 50 and mn.get_channel(3) < 10
+
+def test_bad_fades_rejected_when_built():
+    mn = dmx.ManolatorDmxController(setup_parallel())
+    for channel, value in ((5, 256), (257, 10)):
+        try:
+            mn.new_change().set(time=0, channel=channel, value=value)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError"
+    # modifications built without a controller are checked when they're executed
+    mod = dmx.DmxModification()
+    mod.set(time=0, channel=5, value=0).set(time=1, channel=5, value=300)
+    try:
+        mn.execute_change(mod)
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+def overshoot(percentage, last_val, next_val):
+    return last_val + ((next_val - last_val) * percentage * 2)
+
+class FailingRunner(dmx.DmxRunner):
+    channels = set([7])
+    duration = 1
+
+    def step_at(self, t):
+        raise RuntimeError("broken runner")
+
+def test_failing_fades_are_isolated():
+    mn = dmx.ManolatorDmxController(setup_parallel(), fade_interval=0.005)
+    good = mn.new_change()
+    good.set(time=0, channel=5, value=0).set(time=0.1, channel=5, value=200)
+    good.execute(interval=0.005)
+    # goes past 255 half way through, failing its writes
+    bad = mn.new_change()
+    bad.set(time=0, channel=6, value=0).set(time=0.1, channel=6, value=200, easing=overshoot)
+    bad.execute(interval=0.005)
+    failing = FailingRunner(mn, interval=0.005)
+    failing.start()
+
+    assert good.runner.join(1) and bad.runner.join(1) and failing.join(1)
+    assert not good.runner.cancelled
+    assert bad.runner.cancelled and failing.cancelled
+    assert mn.get_channel(5) == 200 and mn.get_channel(6) <= 255
+
+    # and the scheduler is still going
+    assert mn.fade_scheduler.is_alive()
+    after = mn.new_change()
+    after.set(time=0, channel=8, value=0).set(time=0.02, channel=8, value=99)
+    after.execute(interval=0.005)
+    assert after.runner.join(1) and not after.runner.cancelled
+    assert mn.get_channel(8) == 99
+    mn.stop_fade_scheduler()
+
+def test_shared_fades_are_mixed():
+    mn = dmx.ManolatorDmxController(setup_parallel(), fade_interval=0.005)
+    mn.set_channel_mode([1], dmx.DMX_MERGE_HTP)
+    low = mn.new_change()
+    low.set(time=0, channel=1, value=40).set(time=0.1, channel=1, value=40)
+    high = mn.new_change()
+    high.set(time=0, channel=1, value=90).set(time=0.05, channel=1, value=90)
+    low.execute(interval=0.005, takeover=dmx.DMX_TAKEOVER_SHARE)
+    high.execute(interval=0.005, takeover=dmx.DMX_TAKEOVER_SHARE)
+    assert high.runner.join(1)
+    # the finished fade's value is kept, and still beats the lower one
+    assert mn.get_channel(1) == 90
+    assert low.runner.join(1)
+    assert mn.get_channel(1) == 90
+    assert mn.layers == []
+
+    # a higher priority fade wins whatever its value
+    over = mn.new_change()
+    over.set(time=0, channel=2, value=10).set(time=0.2, channel=2, value=10)
+    over.execute(interval=0.005, priority=1)
+    time.sleep(0.05)
+    mn.set_channel(2, 200)
+    assert mn.get_channel(2) == 10
+    assert over.runner.cancel() and over.runner.cancelled
+    assert not over.runner.cancel()
+    # cancelled where it was, which (being ltp) replaces the manual value
+    assert mn.get_channel(2) == 10
+
+def test_runner_controls():
+    mn = dmx.ManolatorDmxController(setup_parallel(), fade_interval=0.005)
+    mod = mn.new_change()
+    mod.set(time=0, channel=1, value=0).set(time=10, channel=1, value=200)
+    mod.execute(interval=0.005, speed=100)
+    assert mod.runner.join(1)
+    assert mn.get_channel(1) == 200
+
+    mod = mn.new_change()
+    mod.set(time=0, channel=2, value=0).set(time=10, channel=2, value=200)
+    mod.execute(interval=0.005)
+    mod.runner.pause()
+    mod.runner.seek(5)
+    time.sleep(0.05)
+    assert mn.get_channel(2) == 100 and mod.runner.position() == 5
+    mod.runner.set_speed(1000)
+    assert not mod.runner.join(0.05)
+    mod.runner.resume()
+    assert mod.runner.join(1) and not mod.runner.cancelled
+    assert mn.get_channel(2) == 200
+
+def test_layer_merging():
+    mn = dmx.ManolatorDmxController(setup_parallel())
+    mn.set_channels({1: 100, 2: 100, 3: 100})
+    mn.set_channel_mode([2], dmx.DMX_MERGE_HTP)
+    stream = mn.open_layer("stream")
+    stream.set_channels({1: 50, 2: 50})
+    # ltp: the stream wrote last; htp: the manual value is higher
+    assert mn.get_channels([1, 2, 3]) == {1: 50, 2: 100, 3: 100}
+    mn.set_channels({1: 70, 2: 30})
+    assert mn.get_channels([1, 2]) == {1: 70, 2: 50}
+
+    override = mn.open_layer("override", priority=1)
+    override.set_channel_range(1, b"\x05\x05")
+    assert mn.get_channels([1, 2, 3]) == {1: 5, 2: 5, 3: 100}
+    override.release()
+    assert mn.get_channels([1, 2, 3]) == {1: 70, 2: 50, 3: 100}
+    stream.release()
+    assert mn.get_channels([1, 2, 3]) == {1: 70, 2: 30, 3: 100}
+    assert mn.layers == []
+
+def test_snapshot_restart():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "universe.snap")
+        mn = dmx.ManolatorDmxController(setup_parallel(), snapshot_path=path)
+        mn.start()
+        try:
+            mn.set_channels({1: 10, 2: 20})
+            mn.fill_channel_range(100, 3, 40)
+        finally:
+            mn.stop()
+
+        # comes back with the last look, apart from explicit starting values
+        output = setup_parallel()
+        mn = dmx.ManolatorDmxController(output, snapshot_path=path, starting_values={1: 99, 3: 30})
+        assert mn.get_channels([1, 2, 3, 4, 101]) == {1: 99, 2: 20, 3: 30, 4: 0, 101: 40}
+        mn.start()
+        try:
+            frame = output.wait_for_frame(lambda frame: True)
+            assert frame[:3] == b"\x63\x14\x1e" and frame[100] == 40
+            # only the channels written are copied in
+            mn.snapshot.mm[mn.snapshot.offset + 50] = "\x07"
+            mn.set_channels({5: 55, 60: 66})
+            assert mn.snapshot.mm[mn.snapshot.offset + 50] == "\x07"
+            assert snapshot.UniverseSnapshot(path, 257).load()[60] == 66
+        finally:
+            mn.stop()
+
+        # a snapshot of a different universe is ignored
+        mn = dmx.ManolatorDmxController(setup_parallel(), snapshot_path=path, channel_count=16)
+        assert mn.get_channels([1, 2]) == {1: 0, 2: 0}
+        assert snapshot.UniverseSnapshot(path, 17).load() == {}
+    finally:
+        shutil.rmtree(tmpdir)
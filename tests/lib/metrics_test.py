@@ -0,0 +1,55 @@
+import backends
+import dmx
+import metrics
+
+def test_histogram():
+    histogram = metrics.DmxHistogram(bounds=(0.001, 0.01, 0.1))
+    assert histogram.format() == "count=0"
+    for value in [0.0005] * 90 + [0.005] * 9 + [3]:
+        histogram.record(value)
+    assert histogram.counts == [90, 9, 0, 1]
+    assert histogram.percentile(0.5) == 0.001
+    assert histogram.percentile(0.99) == 0.01
+    assert histogram.percentile(1) == 3
+    assert histogram.format().startswith("count=100 ")
+
+def test_controller_metrics():
+    dmx_metrics = metrics.DmxMetrics()
+    output = backends.RecordingOutput()
+    mn = dmx.ManolatorDmxController(output, frame_rate=100, fade_interval=0.005, metrics=dmx_metrics)
+    mn.start()
+    try:
+        mod = mn.new_change()
+        mod.set(time=0, channel=1, value=0).set(time=0.1, channel=1, value=255)
+        mod.execute(interval=0.005)
+        assert mod.runner.join(1)
+        assert output.wait_for_frame(lambda frame: frame[0] == 255) is not None
+    finally:
+        mn.stop()
+    assert dmx_metrics.counter("fades.started").value == 1
+    assert dmx_metrics.counter("fades.finished").value == 1
+    assert dmx_metrics.counter("output.frames").value >= 2
+    assert dmx_metrics.histogram("controller.lock_wait").count >= 2
+    lines = dmx_metrics.format().split("\n")
+    assert "fades.started 1" in lines
+    assert any(line.startswith("output.interval count=") for line in lines)
+
+def test_active_fades_gauge():
+    dmx_metrics = metrics.DmxMetrics()
+    mn = dmx.ManolatorDmxController(backends.RecordingOutput(), frame_rate=100, fade_interval=0.005, metrics=dmx_metrics)
+    mn.start()
+    try:
+        short = mn.new_change()
+        short.set(time=0, channel=1, value=0).set(time=0.05, channel=1, value=255)
+        short.execute(interval=0.005)
+        long = mn.new_change()
+        long.set(time=0, channel=2, value=0).set(time=10, channel=2, value=255)
+        long.execute(interval=0.005)
+        assert dmx_metrics.gauge("fades.active").value == 2
+        assert short.runner.join(1)
+        assert dmx_metrics.gauge("fades.active").value == 1
+        # cancelled while the scheduler has nothing else to tick
+        assert long.runner.cancel()
+        assert dmx_metrics.gauge("fades.active").value == 0
+    finally:
+        mn.stop()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import time
+
+import backends
+import dmx
+import recorder
+
+def make_frames(count, size=512):
+    frames = []
+    frame = bytearray(size)
+    for i in range(count):
+        frame[i % size] = (i * 7) % 256
+        frame[(i * 13) % size] = i % 256
+        frames.append((i * 0.025, bytes(frame)))
+    return frames
+
+def test_recording_round_trip():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        frames = make_frames(500)
+        for compress in (False, True):
+            path = os.path.join(tmpdir, "show.rec")
+            rec = recorder.FrameRecorder(path, compress=compress, keyframe_interval=50)
+            for t, frame in frames:
+                rec.record(t, frame)
+            rec.close()
+            assert rec.frames_written == 500 and rec.frames_dropped == 0
+            # far smaller than the frames themselves
+            assert os.path.getsize(path) < 500 * 512 / 4
+            assert [(t, bytes(frame)) for t, frame in recorder.read_recording(path)] == frames
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_truncated_recording():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "show.rec")
+        rec = recorder.FrameRecorder(path)
+        for t, frame in make_frames(10):
+            rec.record(t, frame)
+        rec.close()
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+        assert len(list(recorder.read_recording(path))) == 9
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_record_and_replay():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "show.rec")
+        output = backends.RecordingOutput()
+        mn = dmx.ManolatorDmxController(output, frame_rate=100, partial_frames=True)
+        mn.start()
+        rec = recorder.FrameRecorder(path, compress=True).attach(mn)
+        try:
+            mn.set_channel(1, 10)
+            assert output.wait_for_frame(lambda frame: frame[0] == 10) is not None
+            mn.set_channels({2: 20, 200: 30})
+            assert output.wait_for_frame(lambda frame: len(frame) >= 200 and frame[199] == 30) is not None
+        finally:
+            rec.close()
+            mn.stop()
+        assert not mn.frame_listeners
+
+        frames = list(recorder.read_recording(path))
+        # listeners see whole frames even when only part was output
+        assert all(len(frame) == dmx.DMX_MAX_CHANNEL for t, frame in frames)
+        last = frames[-1][1]
+        assert last[0] == 10 and last[1] == 20 and last[199] == 30
+
+        sleeps = []
+        target = dmx.ManolatorDmxController(backends.RecordingOutput())
+        assert recorder.replay(path, target, speed=2, sleep=sleeps.append) == len(frames)
+        assert target.get_channels([1, 2, 200]) == {1: 10, 2: 20, 200: 30}
+        assert all(delay <= (frames[-1][0] / 2) + 0.01 for delay in sleeps)
+    finally:
+        shutil.rmtree(tmpdir)
+
+class SlowController(dmx.DummyDmxController):
+    def __init__(self, *args, **kwargs):
+        self.frames = []
+        super(SlowController, self).__init__(*args, **kwargs)
+
+    def set_channel_range(self, start, data):
+        # far behind the recording after the first frame
+        time.sleep(0.05)
+        self.frames.append(bytes(data))
+
+def test_replay_always_plays_the_last_frame():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "show.rec")
+        rec = recorder.FrameRecorder(path)
+        frames = make_frames(20)
+        for t, frame in frames:
+            rec.record(t * 0.01, frame)
+        rec.close()
+        controller = SlowController()
+        played = recorder.replay(path, controller, speed=20)
+        assert played == len(controller.frames) < len(frames)
+        assert controller.frames[-1] == frames[-1][1]
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,424 @@
+import socket
+import threading
+import time
+
+import backends
+import cuelist
+import dmx
+import dmxserver
+import metrics
+
+def setup_controller():
+    return dmx.ManolatorDmxController(backends.RecordingOutput())
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def connect(server):
+    sock = socket.create_connection(server.server_address[:2], timeout=3)
+    f = sock.makefile("rb")
+    assert f.readline() == "READY (? for help)\n"
+    return sock, f
+
+def command(conn, line):
+    sock, f = conn
+    sock.sendall(line + "\n")
+    return f.readline()
+
+def parse_values(response):
+    assert response.startswith("OK ")
+    return dict(tuple(int(z) for z in pair.split(":")) for pair in response[3:].strip().split(","))
+
+def check_concurrent_clients(server):
+    thread = start_server(server)
+    try:
+        clients = [connect(server) for _ in range(5)]
+        for i, conn in enumerate(clients):
+            assert command(conn, "set {}:{}".format(i + 1, i * 10)) == "OK\n"
+        for i, conn in enumerate(reversed(clients)):
+            assert parse_values(command(conn, "getm 1,2,3,4,5")) == {1: 0, 2: 10, 3: 20, 4: 30, 5: 40}
+        assert command(clients[0], "wibble") == "ERROR Invalid command\n"
+        assert command(clients[0], "f 9:100:0:Y") == "OK\n"
+        assert command(clients[1], "bye") == "BYE cya\n"
+        for sock, f in clients:
+            sock.close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+
+def test_threaded_server():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), dmxserver.DmxTcpHandler)
+    check_concurrent_clients(server)
+    server.server_close()
+
+def test_async_server():
+    check_concurrent_clients(dmxserver.AsyncDmxServer(setup_controller(), ("localhost", 0)))
+
+def test_async_server_fade_notification():
+    server = dmxserver.AsyncDmxServer(setup_controller(), ("localhost", 0))
+    thread = start_server(server)
+    try:
+        conn = connect(server)
+        assert command(conn, "f 9:0:100:1") == "ASYNCPENDING 1\n"
+        assert conn[1].readline() == "ASYNCDONE 1\n"
+        assert command(conn, "get 9") == "OK 9:100\n"
+    finally:
+        server.shutdown()
+        thread.join(3)
+
+def test_threaded_slow_client_does_not_hold_up_fades():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), dmxserver.DmxTcpHandler)
+    thread = start_server(server)
+    try:
+        # a client that stops reading: its socket fills up before its fade finishes
+        slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.connect(server.server_address[:2])
+        slow.sendall("f 9:0:100:1\n" + "getm\n" * 2000)
+        conn = connect(server)
+        assert command(conn, "f 10:0:100:2") == "ASYNCPENDING 1\n"
+        assert conn[1].readline() == "ASYNCDONE 1\n"
+        assert command(conn, "getm 9,10") == "OK 9:100,10:100\n"
+        slow.close()
+        conn[0].close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+    server.server_close()
+
+class SmallQueueHandler(dmxserver.DmxTcpHandler):
+    output_queue_bytes = 8192
+    handlers = []
+
+    def __init__(self, *args, **kwargs):
+        SmallQueueHandler.handlers.append(self)
+        dmxserver.DmxTcpHandler.__init__(self, *args, **kwargs)
+
+def test_threaded_output_queue_is_bounded():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), SmallQueueHandler)
+    thread = start_server(server)
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(server.server_address[:2])
+        sock.settimeout(5)
+        # pipelined without reading any replies (from another thread, as sending blocks once the server stops reading)
+        line = "getm " + ",".join(str(ch) for ch in range(1, 41)) + "\n"
+        reply = "OK " + ",".join("{}:0".format(ch) for ch in range(1, 41)) + "\n"
+        lines = 30000
+        sender = threading.Thread(target=sock.sendall, args=(line * lines,))
+        sender.daemon = True
+        sender.start()
+        handler = SmallQueueHandler.handlers[-1]
+        # the queue fills up, but (at most one batch of replies, a recv's worth of lines, past the limit) no further
+        largest = 0
+        for _ in range(1000):
+            largest = max(largest, handler.outbound.size)
+            time.sleep(0.001)
+        assert 8192 <= largest <= 8192 + (65536 / len(line) + 1) * len(reply)
+
+        # nothing was dropped: the server just waited for us
+        f = sock.makefile("rb")
+        assert f.readline() == "READY (? for help)\n"
+        for _ in range(lines):
+            assert f.readline() == reply
+        sender.join(3)
+        sock.close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+    server.server_close()
+
+def test_fade_controls():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), dmxserver.DmxTcpHandler)
+    thread = start_server(server)
+    try:
+        conn = connect(server)
+        assert command(conn, "f 9:0:100:600") == "ASYNCPENDING 1\n"
+        assert command(conn, "pause 1") == "OK\n"
+        assert command(conn, "seek 1 300") == "OK\n"
+        # the seek shows straight away, even though it's paused
+        time.sleep(0.3)
+        assert command(conn, "get 9") == "OK 9:50\n"
+        assert command(conn, "speed 1 0.5") == "OK\n"
+        # the fade can finish (and say so) before the reply is sent
+        assert sorted([command(conn, "seek 1 end"), conn[1].readline()]) == ["ASYNCDONE 1\n", "OK\n"]
+        assert command(conn, "get 9") == "OK 9:100\n"
+        assert command(conn, "pause 1") == "ERROR No fade running as 1\n"
+
+        assert command(conn, "f 10:0:100:600") == "ASYNCPENDING 2\n"
+        # cancelling finishes it there and then, so ASYNCDONE comes first
+        assert command(conn, "cancel 2") == "ASYNCDONE 2 CANCELLED\n"
+        assert conn[1].readline() == "OK\n"
+        value = int(command(conn, "get 10").strip().split(":")[1])
+        assert value < 5
+        conn[0].close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+    server.server_close()
+
+def test_go_cues():
+    mn = setup_controller()
+    cues = cuelist.DmxCueList.from_dict({"cues": [
+        {"number": 1, "name": "Preshow", "keyframes": [{"time": 0, "channel": 5, "value": 0}, {"time": 0.1, "channel": 5, "value": 80}]},
+        {"number": 2, "keyframes": [{"time": 0, "channel": 5, "value": 80}, {"time": 0.1, "channel": 5, "value": 0}]},
+    ]}, mn)
+    server = dmxserver.ThreadedDmxTcpServer(mn, ("localhost", 0), dmxserver.DmxTcpHandler, cues=cues)
+    thread = start_server(server)
+    try:
+        conn = connect(server)
+        assert command(conn, "cues") == "OK 1 0.10s Preshow\n"
+        assert conn[1].readline() == "OK 2 0.10s\n"
+        assert command(conn, "go") == "ASYNCPENDING 1\n"
+        assert conn[1].readline() == "ASYNCDONE 1\n"
+        assert command(conn, "get 5") == "OK 5:80\n"
+        assert command(conn, "go 2") == "ASYNCPENDING 2\n"
+        assert conn[1].readline() == "ASYNCDONE 2\n"
+        assert command(conn, "get 5") == "OK 5:0\n"
+        assert command(conn, "go 3") == "ERROR No cue 3\n"
+        conn[0].close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+    server.server_close()
+
+def test_stats():
+    parser = dmxserver.DmxCommandParser(setup_controller(), StubHandler())
+    assert run_parser_line(parser, "stats") == ("ValueError", "Metrics are disabled")
+
+    mn = dmx.ManolatorDmxController(backends.RecordingOutput(), metrics=metrics.DmxMetrics())
+    server = dmxserver.ThreadedDmxTcpServer(mn, ("localhost", 0), dmxserver.DmxTcpHandler)
+    thread = start_server(server)
+    try:
+        conn = connect(server)
+        assert command(conn, "set 1:5\nset 2:6\nget 1\nnonsense") == "OK\n"
+        assert [conn[1].readline() for _ in range(3)] == ["OK\n", "OK 1:5\n", "ERROR Invalid command\n"]
+        # one line per metric, then version to mark the end
+        conn[0].sendall("stats\nversion\n")
+        lines = []
+        while not lines or not lines[-1].startswith("OK Server"):
+            lines.append(conn[1].readline())
+        names = [line.split()[1] for line in lines[:-1]]
+        assert "command.get" in names and "command.other" in names and "command.sets" in names
+        conn[0].close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+    server.server_close()
+
+class CountingController(dmx.ManolatorDmxController):
+    def __init__(self, *args, **kwargs):
+        self.set_calls = 0
+        super(CountingController, self).__init__(*args, **kwargs)
+    def _set_channels(self, channel_set):
+        self.set_calls += 1
+        super(CountingController, self)._set_channels(channel_set)
+
+def check_pipelined_sets(server):
+    thread = start_server(server)
+    try:
+        sock, f = connect(server)
+        lines = ["set {}:{}".format(ch, ch % 256) for ch in range(1, 201)]
+        lines[50] = "set 999:1"
+        lines[100] = "setm 7:1,8:300"
+        lines.append("getm 1,2,51,200")
+        lines.append("set 1:99")
+        sock.sendall("".join(line + "\n" for line in lines))
+        responses = [f.readline() for _ in lines]
+        assert responses[50] == "ERROR Channel ID '999' out of range\n"
+        assert responses[100] == "ERROR DMX value '300' out of range\n"
+        assert parse_values(responses[200]) == {1: 1, 2: 2, 51: 0, 200: 200}
+        assert responses.count("OK\n") == len(lines) - 3
+        # the 199 good sets before the getm are applied at once, then the last one
+        assert server.dmx.set_calls == 2
+        sock.close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+
+def test_threaded_pipelined_sets():
+    server = dmxserver.ThreadedDmxTcpServer(CountingController(backends.RecordingOutput()), ("localhost", 0), dmxserver.DmxTcpHandler)
+    check_pipelined_sets(server)
+    server.server_close()
+
+def test_async_pipelined_sets():
+    check_pipelined_sets(dmxserver.AsyncDmxServer(CountingController(backends.RecordingOutput()), ("localhost", 0)))
+
+class StubHandler(object):
+    def __init__(self):
+        self.async_command_id = 0
+    def track_async_runner(self, runner):
+        self.async_command_id += 1
+        return self.async_command_id
+
+def run_parser_line(parser, line):
+    try:
+        return "OK", parser.process_command(line)
+    except Exception, ex:
+        return type(ex).__name__, str(ex)
+
+def test_fill_and_getm():
+    parser = dmxserver.DmxCommandParser(setup_controller(), StubHandler())
+    assert run_parser_line(parser, "fill 3+2:9") == ("OK", None)
+    status, response = run_parser_line(parser, "getm")
+    values = parse_values("OK " + response)
+    assert len(values) == 256 and values[2] == 0 and values[3] == values[4] == 9 and values[5] == 0
+
+def test_fast_paths_match_regexes():
+    lines = [
+        "set 5:10", "set 5:300", "set 999:1", "set 5:", "set :5", "set 5:1:2", "set 5:1,6:2", "set", "set ", "c 5:20", "c 5",
+        "setm 1:2,3:4", "setm 1:2,", "setm 1:2,3", "setm ", "setm", "setm 1:2,999:3", "setm 1:256", "setm 1:2 ",
+        "getm", "getm ", "getm 1,2,3", "getm 256,20,3,1,3", "getm 0,5", "getm 1,,2", "getm 1,999", "getmx", "get 5", "?", "v", "wibble", "",
+    ]
+    for line in lines:
+        results = []
+        for fast_paths in (True, False):
+            parser = dmxserver.DmxCommandParser(setup_controller(), StubHandler())
+            parser.fast_paths = fast_paths
+            results.append((run_parser_line(parser, line), parser.dmx.get_channels(range(1, 11)), run_parser_line(parser, "getm")))
+        assert results[0] == results[1], line
+
+def test_parse_set_command():
+    parser = dmxserver.DmxCommandParser(setup_controller(), StubHandler())
+    assert parser.parse_set_command("setm 1:2,3:4") == {1: 2, 3: 4}
+    assert parser.parse_set_command("c 5:6") == {5: 6}
+    assert parser.parse_set_command("c 5") is None
+    assert parser.parse_set_command("getm") is None
+
+def read_binary(f):
+    length, msg_type = dmxserver.BINARY_HEADER.unpack(f.read(dmxserver.BINARY_HEADER.size))
+    return msg_type, f.read(length)
+
+def check_binary_protocol(server):
+    thread = start_server(server)
+    try:
+        sock, f = connect(server)
+        frame = "".join(chr(ch % 256) for ch in range(1, 257))
+        messages = [
+            dmxserver.binary_message(dmxserver.BINARY_SET_FRAME, frame),
+            dmxserver.binary_message(dmxserver.BINARY_SET_RANGE, dmxserver.BINARY_RANGE.pack(10) + "\x01\x02\x03"),
+            dmxserver.binary_message(dmxserver.BINARY_GET_RANGE, dmxserver.BINARY_GET.pack(9, 5)),
+            dmxserver.binary_message(dmxserver.BINARY_SET_RANGE, dmxserver.BINARY_RANGE.pack(255) + "\x01\x02\x03"),
+            dmxserver.binary_message(dmxserver.BINARY_FADE,
+                dmxserver.BINARY_KEYFRAME.pack(0, 20, 0, 0) + dmxserver.BINARY_KEYFRAME.pack(0.05, 20, 250, 3)),
+        ]
+        # the switch and the first messages arrive together
+        sock.sendall("set 1:5\nbinary\n" + "".join(messages))
+        assert f.readline() == "OK\n"
+        assert f.readline() == "OK BINARY\n"
+        assert read_binary(f) == (dmxserver.BINARY_OK, "")
+        assert read_binary(f) == (dmxserver.BINARY_OK, "")
+        assert read_binary(f) == (dmxserver.BINARY_DATA, dmxserver.BINARY_RANGE.pack(9) + "\x09\x01\x02\x03\x0d")
+        assert read_binary(f)[0] == dmxserver.BINARY_ERROR
+        assert read_binary(f) == (dmxserver.BINARY_ASYNCPENDING, dmxserver.BINARY_COMMAND_ID.pack(1))
+        assert read_binary(f) == (dmxserver.BINARY_ASYNCDONE, dmxserver.BINARY_COMMAND_ID.pack(1))
+        sock.sendall(dmxserver.binary_message(dmxserver.BINARY_TEXT) + "getm 1,20,256\n")
+        assert read_binary(f) == (dmxserver.BINARY_OK, "")
+        assert parse_values(f.readline()) == {1: 1, 20: 250, 256: 0}
+        sock.close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+
+def test_threaded_binary_protocol():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), dmxserver.DmxTcpHandler)
+    check_binary_protocol(server)
+    server.server_close()
+
+def test_async_binary_protocol():
+    check_binary_protocol(dmxserver.AsyncDmxServer(setup_controller(), ("localhost", 0)))
+
+def stream_frame(data):
+    return dmxserver.STREAM_HEADER.pack(len(data)) + data
+
+def check_stream_session(server):
+    thread = start_server(server)
+    try:
+        sock, f = connect(server)
+        other = connect(server)
+        assert command(other, "setm 1:10,2:10,3:10") == "OK\n"
+        assert command(other, "merge htp 2") == "OK\n"
+        # only the last of frames arriving together is applied
+        frames = [stream_frame(chr(v) * 3) for v in (1, 2, 3)]
+        sock.sendall("stream 1\n" + "".join(frames))
+        assert f.readline() == "OK STREAMING\n"
+        sock.sendall(stream_frame("\x00\x05"))
+        stats = command(other, "streams")
+        assert stats.startswith("OK stream") and "priority=1" in stats
+        sock.sendall(stream_frame("") + "getm 1,2,3\n")
+        assert f.readline() == "OK STREAM ENDED\n"
+        assert parse_values(f.readline()) == {1: 10, 2: 10, 3: 10}
+        assert command(other, "streams") == "OK\n"
+        sock.close()
+        other[0].close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+
+def test_threaded_stream_session():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), dmxserver.DmxTcpHandler)
+    check_stream_session(server)
+    server.server_close()
+
+def test_async_stream_session():
+    check_stream_session(dmxserver.AsyncDmxServer(setup_controller(), ("localhost", 0)))
+
+def check_subscriptions(server):
+    thread = start_server(server)
+    try:
+        watchers = [connect(server) for _ in range(3)]
+        setter = connect(server)
+        assert command(setter, "set 2:7") == "OK\n"
+        assert parse_values(command(watchers[0], "subscribe 1,2")) == {1: 0, 2: 7}
+        assert parse_values(command(watchers[1], "subscribe 1,2")) == {1: 0, 2: 7}
+        assert command(watchers[2], "subscribe 3") == "OK 3:0\n"
+        # both sets land within one tick, so they're coalesced into a single CHANGED
+        assert command(setter, "set 1:10\nset 1:20") == "OK\n"
+        assert setter[1].readline() == "OK\n"
+        for sock, f in watchers[:2]:
+            assert f.readline() == "CHANGED 1:20\n"
+        assert command(watchers[0], "unsubscribe") == "OK\n"
+        assert command(setter, "setm 1:30,3:40") == "OK\n"
+        assert watchers[1][1].readline() == "CHANGED 1:30\n"
+        assert watchers[2][1].readline() == "CHANGED 3:40\n"
+        assert command(watchers[0], "get 1") == "OK 1:30\n"
+        for sock, f in watchers + [setter]:
+            sock.close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+
+def test_threaded_subscriptions():
+    server = dmxserver.ThreadedDmxTcpServer(setup_controller(), ("localhost", 0), dmxserver.DmxTcpHandler,
+        subscription_rate=2)
+    check_subscriptions(server)
+    server.server_close()
+
+def test_async_subscriptions():
+    check_subscriptions(dmxserver.AsyncDmxServer(setup_controller(), ("localhost", 0), subscription_rate=2))
+
+def test_multi_universe_subscriptions_stop_with_the_last_subscriber():
+    controller = dmx.MultiUniverseDmxController([setup_controller(), setup_controller()])
+    server = dmxserver.ThreadedDmxTcpServer(controller, ("localhost", 0), dmxserver.DmxTcpHandler, subscription_rate=20)
+    thread = start_server(server)
+    try:
+        watcher, setter = connect(server), connect(server)
+        for _ in range(2):
+            assert command(watcher, "subscribe 5") == "OK (1, 5):0\n"
+            assert command(setter, "set 5:10") == "OK\n"
+            assert watcher[1].readline() == "CHANGED (1, 5):10\n"
+            assert command(watcher, "unsubscribe") == "OK\n"
+            # nothing left to notify, so nothing is tracked or ticking
+            assert server.subscriptions.stopping is None
+            assert controller.changed_channels is None
+            assert command(setter, "set 5:0") == "OK\n"
+        for sock, f in (watcher, setter):
+            sock.close()
+    finally:
+        server.shutdown()
+        thread.join(3)
+    server.server_close()